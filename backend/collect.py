@@ -1,47 +1,88 @@
 # from dataclasses import dataclass, \
 #    field
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, \
     timezone
+from functools import partial
 from hashlib import sha256
-from json import loads
+from json import dumps, \
+    loads
+from threading import Lock
 # from json.decoder import JSONDecodeError
-from time import sleep
+from urllib.parse import quote
+from time import monotonic, \
+    sleep, \
+    time
 
-from datasize import DataSize
-from dateutil import parser as dateutil_parser, \
-    relativedelta
+from dateutil import relativedelta
 from markdown import markdown
 
 from backend.config import API_SUFFIX, \
     config
-from backend.connection import gitlab_session_get
-from backend.database import couchdb
+from backend.connection import gitlab_session_get, \
+    gitlab_session_head, \
+    request_scheduler, \
+    response_cache
+from backend.database import couchdb, \
+    CouchDBBulkWriter
 from backend.helpers import exit, \
+    humanize_age, \
     log, \
-    plural_or_not
-
-
-def collect_projects() -> list:
+    sort_tags
+from backend.metrics import registry, \
+    stage_duration, \
+    sweep_container_images, \
+    sweep_duration, \
+    sweep_finished, \
+    sweep_items_per_second
+from backend.pipeline import Pipeline, \
+    Stage
+from backend.shards import ShardLeases
+from backend.tags import enrich_tags, \
+    format_size
+from backend.webhook import RefreshQueue, \
+    WebhookServer
+
+# seconds between looking for due shards when no shard could be claimed
+LEASE_POLL_INTERVAL = 60
+# seconds between storing progress of a sweep
+STATUS_INTERVAL = 5
+
+
+def collect_projects():
     """
-    collect all projects
-    :return:
+    collect all projects page by page, using keyset pagination which GitLab serves cheaply even for huge instances
+    :return: generator of projects, so processing can start while further pages are still requested
     """
-    projects_list = list()
-    # due to pagination, we have to start with some 1
-    projects_page = 1
-    projects_total_pages = 1
+    projects_count = 0
+    # the first page is requested with parameters, every following one via the URL in the 'Link' header
+    url = f'{config.api.url}{API_SUFFIX}/projects'
+    params = {'pagination': 'keyset',
+              'order_by': 'id',
+              'sort': 'asc',
+              'per_page': 100}
+    # number of failed attempts in a row
+    failures = 0
 
     # GitLab maximally returns 100 projects per page, so we have to loop through all pages
-    while projects_page <= projects_total_pages:
-        response = gitlab_session_get(f'{config.api.url}{API_SUFFIX}/projects',
-                                      params={'page': projects_page,
-                                              'per_page': 100})
+    # there is no filter for enabled container registries, and 'simple=true' would drop the fields shown by the
+    # web frontend like the container expiration policy - so complete projects are requested
+    while url:
+        with stage_duration.time(stage='projects'):
+            response = gitlab_session_get(url, params=params)
         if response.status_code < 400:
-            # header 'x-total-pages' tells into how many pages the results are split
-            projects_total_pages = int(response.headers.get('x-total-pages'))
-            projects_page += 1
-            projects_list += loads(response.text)
-            log.info(f'Collected {len(projects_list)} projects')
+            # the last page has no link to a next one
+            url = response.links.get('next', dict()).get('url')
+            params = None
+            failures = 0
+            projects = loads(response.text)
+            projects_count += len(projects)
+            log.info(f'Collected {projects_count} projects')
+            for project in projects:
+                # fix None project description
+                if not project['description']:
+                    project['description'] = ''
+                yield project
         elif response.status_code == 401:
             # when token is unauthorized exit immediately
             log.error(f'Token is expired or unauthorized')
@@ -49,23 +90,116 @@ def collect_projects() -> list:
         else:
             log.error(f'status_code: {response.status_code} text: {response.text}')
             print(f'status_code: {response.status_code} text: {response.text}')
-            # try agin after a short nap
-            sleep(20)
+            # even retries did not help - try again after a growing nap
+            sleep(request_scheduler.backoff(failures, response))
+            failures += 1
+
+
+def collect_group_project_ids(group):
+    """
+    collect IDs of projects having container images in a group and its subgroups, page by page
+    :param group: ID or path of group
+    :return: generator of lists of project IDs per page, None if the group could not be listed
+    """
+    page = 1
+    failures = 0
+
+    while page:
+        with stage_duration.time(stage='groups'):
+            response = gitlab_session_get(f"{config.api.url}{API_SUFFIX}/groups/{quote(str(group), safe='')}"
+                                          f"/registry/repositories",
+                                          params={'page': page,
+                                                  'per_page': 100})
+        if response.status_code < 400:
+            # header 'x-next-page' is empty on the last page
+            page = int(response.headers.get('x-next-page') or 0)
+            failures = 0
+            yield [x['project_id'] for x in loads(response.text)]
+        elif response.status_code == 401:
+            # when token is unauthorized exit immediately
+            log.error('Token is expired or unauthorized')
+            exit(f'status_code: {response.status_code} text: {response.text}')
+        elif response.status_code in (403, 404):
+            log.error(f'Error listing container registry of group {group}: '
+                      f'status_code: {response.status_code} text: {response.text}')
+            yield None
+            return
+        else:
+            log.error(f'status_code: {response.status_code} text: {response.text}')
+            # even retries did not help - try again after a growing nap
+            sleep(request_scheduler.backoff(failures, response))
+            failures += 1
+
 
-    for project in projects_list:
+def collect_group_projects(groups: list, sweep):
+    """
+    collect projects having container images in the given groups - projects without any are never requested
+    :param groups: IDs or paths of groups
+    :param sweep: sweep to be marked incomplete if a group could not be listed
+    :return: generator of projects
+    """
+    project_ids = set()
+    with ThreadPoolExecutor(max_workers=config.collector.workers.repositories) as executor:
+        for group in groups:
+            for page_project_ids in collect_group_project_ids(group):
+                if page_project_ids is None:
+                    sweep.incomplete()
+                    continue
+                # several container images of a project and groups containing each other share projects
+                new_project_ids = list()
+                for project_id in page_project_ids:
+                    if project_id not in project_ids and (sweep.shard is None or
+                                                          project_id % config.collector.shards == sweep.shard):
+                        project_ids.add(project_id)
+                        new_project_ids.append(project_id)
+                for project_id, project in zip(new_project_ids, executor.map(collect_project, new_project_ids)):
+                    if project:
+                        yield project
+                    else:
+                        # keep its container images until the project can be requested again
+                        sweep.fail(project_id)
+    log.info(f'Found {len(project_ids)} projects with container images in groups {groups}')
+
+
+def collect_project(reference) -> dict:
+    """
+    get a single project
+    :param reference: project ID or path of project including namespace
+    :return: project or None if it could not be found
+    """
+    # paths have to be URL-encoded to be accepted as ID
+    response = gitlab_session_get(f"{config.api.url}{API_SUFFIX}/projects/{quote(str(reference), safe='')}")
+    if response.status_code == 200:
+        project = loads(response.text)
         # fix None project description
         if not project['description']:
             project['description'] = ''
+        return project
+    if response.status_code != 404:
+        log.error(f'Error collecting project {reference}: status_code: {response.status_code} text: {response.text}')
+    return None
 
-    return projects_list
+
+def collect_project_of_repository(repository_path: str) -> dict:
+    """
+    get project of a container image - its path starts with the path of the project
+    :param repository_path: path of container image like 'group/project/image'
+    :return: project or None if it could not be found
+    """
+    parts = repository_path.strip('/').split('/')
+    # the longest matching path is the project, shorter ones might be projects too
+    for length in range(len(parts), 1, -1):
+        project = collect_project('/'.join(parts[:length]))
+        if project:
+            return project
+    return None
 
 
-def collect_project_container_images(project) -> dict:
+def collect_project_container_images(project) -> list:
     """
     enrich container_images with details of projects
-    :param container_images:
-    :param projects_list:
-    :return:
+    :param project:
+    :return: list of container images or None if they could not be listed
     """
     result = list()
     project_id = project.get('id')
@@ -75,16 +209,23 @@ def collect_project_container_images(project) -> dict:
                                       params={'tags': True,
                                               'tags_count': True,
                                               'size': True})
-        repositories = loads(response.text)
+        if response.status_code < 400:
+            repositories = loads(response.text)
+        else:
+            log.error(f"Error collecting container images for project {project_id}: "
+                      f"status_code: {response.status_code} text: {response.text}")
+            return None
     except Exception as exception:
         log.error(f"Error collecting container images for project {project_id}: {exception}")
         log.error(f"Project data: {project}")
-        repositories = list()
+        return None
 
     if repositories:
         # collect all images of a project
         for container_image in repositories:
             try:
+                # fingerprint of the listing has to be taken before the container image gets enriched
+                container_image['watermark'] = collect_project_container_image_watermark(project, container_image)
                 container_image['project'] = project
                 # fix name which basically is the same as path
                 container_image['name'] = container_image['location']
@@ -97,69 +238,93 @@ def collect_project_container_images(project) -> dict:
     return result
 
 
+def collect_project_container_image_watermark(project: dict, container_image: dict) -> str:
+    """
+    fingerprint of a container image as listed in its project - it moves when tags were pushed or deleted or
+    the project itself was active, e.g. by a commit changing the README
+    :param project:
+    :param container_image: container image as delivered by the repositories listing
+    :return: hash of the listing
+    """
+    listing = {'last_activity_at': project.get('last_activity_at'),
+               'container_image': container_image}
+    return sha256(dumps(listing, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def collect_project_container_images_tag_details(project_id: int, container_image_id: int, tag_name: str) -> dict:
+    """
+    get details of a single tag of a container repository
+    :param project_id:
+    :param container_image_id:
+    :param tag_name:
+    :return: tag details or None if they could not be retrieved
+    """
+    try:
+        response = gitlab_session_get(
+            f'{config.api.url}{API_SUFFIX}/projects/{project_id}/registry/repositories/{container_image_id}/tags/{tag_name}',
+            params={'tags': True,
+                    'tags_count': True,
+                    'size': True},
+            # thousands of small tag responses would push the listings out of the cache every sweep
+            cache=False)
+        if response.status_code < 400:
+            return loads(response.text)
+        log.error(f'Error collecting tag {tag_name} of container image {container_image_id} '
+                  f'for project {project_id}: status_code: {response.status_code} text: {response.text}')
+    except Exception as exception:
+        log.error(f'Error collecting tag {tag_name} of container image {container_image_id} '
+                  f'for project {project_id}: {exception}')
+    return None
+
+
 def collect_project_container_images_tag(container_image: dict) -> dict:
     """
     get all tags of a container repository of a project
     :param container_image:
-    :return:
+    :return: container image or None if details of any tag could not be retrieved
     """
     container_image_id = container_image['id']
     project_id = container_image['project_id']
-    tags = dict()
-    for tag in container_image['tags']:
-        tag_name = tag.get('name')
-        response = gitlab_session_get(
-            f'{config.api.url}{API_SUFFIX}/projects/{project_id}/registry/repositories/{container_image_id}/tags/{tag_name}',
-            params={'tags': True,
-                    'tags_count': True,
-                    'size': True})
-        tags[tag_name] = loads(response.text)
+    tag_names = [tag.get('name') for tag in container_image['tags']]
+    tag_concurrency = config.collector.tag_concurrency
+    if tag_concurrency > 1 and len(tag_names) > 1:
+        # the GitLab session is thread-safe and shares its connection pool among the workers
+        with ThreadPoolExecutor(max_workers=min(tag_concurrency, len(tag_names))) as executor:
+            # map() keeps the order of the tag names, so the result is the same as sequential requests
+            tags_details = list(executor.map(lambda tag_name: collect_project_container_images_tag_details(
+                project_id, container_image_id, tag_name), tag_names))
+    else:
+        tags_details = [collect_project_container_images_tag_details(project_id, container_image_id, tag_name)
+                        for tag_name in tag_names]
+    failed = [tag_name for tag_name, tag_details in zip(tag_names, tags_details) if tag_details is None]
+    if failed:
+        # a shortened tag list would overwrite the complete one stored before
+        log.error(f"Not storing container image {container_image['location']} - "
+                  f"details of {len(failed)} of {len(tag_names)} tags could not be retrieved")
+        return None
     # overwrite tags with more detailed info
-    container_image['tags'] = tags
+    container_image['tags'] = dict(zip(tag_names, tags_details))
 
     return container_image
 
 
 def collect_project_container_image_tags_humanize(container_image: dict) -> dict:
     """
-    get all tags of a container repository of a project
+    add human-readable values and revision colors to tags and summarize them for the container image
     :param container_image:
     :return:
     """
     # 'now' is needed for age calculation of images
     NOW = datetime.now(timezone.utc)
 
-    # empty default values may better be '' than None to avoid concat crashes
-    container_image['last_update'] = ''
-    container_image['last_update_tag'] = ''
+    summary = enrich_tags(container_image['tags'])
+    container_image['last_update'] = summary.last_update
+    container_image['last_update_tag'] = summary.last_update_tag
     # 'tag' will be identical to 'last_update_tag' and stored for sortability in the UI
-    container_image['tag'] = ''
-    # the whole sum of all images tags
-    container_image['size'] = 0
-    # get last update date
-    for tag in container_image['tags'].values():
-        # parse time string from Gitlab into datetime object
-        if tag.get('created_at'):
-            tag_created_at = dateutil_parser.parse(tag.get('created_at'))
-            # when currently checked tag is newer than latest known it become the new last_update
-            if container_image['last_update']:
-                if container_image['last_update'] < tag_created_at:
-                    container_image['last_update'] = tag_created_at
-                    container_image['last_update_tag'] = tag['name']
-                    container_image['tag'] = tag['name']
-            else:
-                container_image['last_update'] = tag_created_at
-                container_image['last_update_tag'] = tag['name']
-                container_image['tag'] = tag['name']
-            # add human-readable tag image size
-            tag['total_size_human_readable'] = '{:.2a}'.format(DataSize(tag['total_size']))
-            # add human-readable tag creation date
-            tag['created_at_human_readable'] = dateutil_parser.parse(tag['created_at']).strftime(
-                '%Y-%m-%d %H:%M:%S')
-            # add size of this tag to total size of container image
-            container_image['size'] += tag['total_size']
+    container_image['tag'] = summary.last_update_tag
+    container_image['size'] = summary.size
     # human-readable version of sum of total_size
-    container_image['size_human_readable'] =  '{:.2a}'.format(DataSize(container_image['size']))
+    container_image['size_human_readable'] = format_size(container_image['size'])
 
     # get age of a container image
     # relativedelta adds all other units like 'years=0' which makes it better comparable
@@ -168,46 +333,154 @@ def collect_project_container_image_tags_humanize(container_image: dict) -> dict
     # store creation date as difference between now and age
     container_image['created'] = NOW - age
     # get a human-readable version of age to be read by humans
-    container_image['age_human_readable'] = ''
-    age_human_readable = 'n/a'
-    if age.years > 0:
-        age_human_readable = f'{plural_or_not(age.years, "year")}'
-    elif age.months > 0:
-        age_human_readable = f'{plural_or_not(age.months, "month")}'
-    elif age.weeks > 0:
-        age_human_readable = f'{plural_or_not(age.weeks, "week")}'
-    elif age.days > 0:
-        age_human_readable = f'{plural_or_not(age.days, "day")}'
-    elif age.hours > 0:
-        age_human_readable = f'{plural_or_not(age.hours, "hour")}'
-    elif age.seconds > 0:
-        age_human_readable = f'{plural_or_not(age.seconds, "second")}'
-    age_human_readable = f'{age_human_readable}'
+    age_human_readable = humanize_age(age)
     container_image['age_human_readable'] = age_human_readable
 
     return container_image
 
 
-def collect_project_container_image_tags_compare_revisions(container_image: dict) -> dict:
-    """
-    get revision hashes for tags which share a revision to make it clear they belong together
-    """
-    # store all revisions
-    revisions = dict()
-    # consider every tag
-    for tag, properties in container_image['tags'].items():
-        revision = properties.get('revision')
-        # default is no background color
-        properties['tag_revision_background_color'] = ''
-        if revision:
-            revisions.setdefault(revision, list())
-            revisions[revision].append(tag)
-    # change only background color for those which have more than 1 which have the same revision
-    for revision in [x for x in revisions.keys() if len(revisions[x]) > 1]:
-        for tag, properties in container_image['tags'].items():
-            if tag in revisions[revision]:
-                properties['tag_revision_background_color'] = revision[0:6]
-    return container_image
+def render_readme(readme_md: str) -> str:
+    """
+    render README markdown to HTML fitting into the README tab
+    :param readme_md:
+    :return:
+    """
+    readme_html = markdown(readme_md,
+                           extensions=['attr_list',
+                                       'def_list',
+                                       'fenced_code',
+                                       'md_in_html',
+                                       'tables'])
+    # decrease the size of headers to make the README tab more readable
+    readme_html = readme_html.replace('<h5>', '<h6>').replace('</h5>', '</h6>')
+    readme_html = readme_html.replace('<h4>', '<h6>').replace('</h4>', '</h6>')
+    readme_html = readme_html.replace('<h3>', '<h5>').replace('</h3>', '</h5>')
+    readme_html = readme_html.replace('<h2>', '<h4>').replace('</h2>', '</h4>')
+    readme_html = readme_html.replace('<h1>', '<h3>').replace('</h1>', '</h3>')
+    return readme_html
+
+
+class ReadmeCache:
+    """
+    rendered READMEs per project, keyed by the blob ID of the README file
+    """
+
+    def __init__(self):
+        # project ID -> dictionary with blob_id, readme_md, readme_html and the run it was checked in
+        self._readmes = dict()
+        # one lock per project, so images of the same project wait for a single download
+        self._locks = dict()
+        self._lock = Lock()
+        # number of the current collector run - READMEs are checked only once per run
+        self.run = 0
+        self.downloads = 0
+
+    def new_run(self) -> None:
+        """
+        start a new collector run, so READMEs get checked again
+        """
+        with self._lock:
+            self.run += 1
+
+    def expire(self, project_ids) -> None:
+        """
+        check READMEs of some projects again, without touching the bookkeeping of a running sweep
+        :param project_ids:
+        """
+        with self._lock:
+            for project_id in project_ids:
+                if project_id in self._readmes:
+                    self._readmes[project_id] = {**self._readmes[project_id], 'run': None}
+
+    def lock(self, project_id: int) -> Lock:
+        """
+        get lock of a project
+        :param project_id:
+        :return:
+        """
+        with self._lock:
+            return self._locks.setdefault(project_id, Lock())
+
+    def get(self, project_id: int) -> dict:
+        return self._readmes.get(project_id)
+
+    def count_download(self) -> None:
+        with self._lock:
+            self.downloads += 1
+
+    def __len__(self):
+        return len(self._readmes)
+
+    def prune(self, in_scope=None) -> int:
+        """
+        forget READMEs of projects not checked in the current run, e.g. deleted ones or ones without registry now
+        only to be called after a full sweep, incremental ones skip unchanged projects
+        :param in_scope: function telling if a project ID was covered by the sweep, None for all
+        :return: number of forgotten READMEs
+        """
+        with self._lock:
+            stale = [x for x, readme in self._readmes.items()
+                     if readme['run'] != self.run and (in_scope is None or in_scope(x))]
+            for project_id in stale:
+                del self._readmes[project_id]
+                self._locks.pop(project_id, None)
+        return len(stale)
+
+    def store(self, project_id: int, blob_id: str, readme_md: str, readme_html: str) -> dict:
+        """
+        store README of a project as checked in the current run
+        :param project_id:
+        :param blob_id: blob ID of the README file, None if unknown
+        :param readme_md:
+        :param readme_html:
+        :return: stored README
+        """
+        readme = {'blob_id': blob_id,
+                  'readme_md': readme_md,
+                  'readme_html': readme_html,
+                  'run': self.run}
+        # without blob ID there is no way to tell if the README changed in later runs
+        if blob_id:
+            self._readmes[project_id] = readme
+        return readme
+
+
+readme_cache = ReadmeCache()
+
+
+def collect_project_readme(project: dict) -> dict:
+    """
+    get README of a project - it is only downloaded and rendered if its blob ID changed
+    :param project:
+    :return: dictionary with readme_md and readme_html or None if the project has no README or it failed
+    """
+    project_id = project['id']
+    readme_file = project['readme_url'].split('/')[-1]
+    url = f'{config.api.url}{API_SUFFIX}/projects/{project_id}/repository/files/{readme_file}'
+    with readme_cache.lock(project_id):
+        readme = readme_cache.get(project_id)
+        # other container images of the project already checked the README in this run
+        if readme and readme['run'] == readme_cache.run:
+            return readme
+        # HEAD delivers the file metadata as headers without its content
+        response = gitlab_session_head(url, params={'ref': 'HEAD'})
+        blob_id = response.headers.get('x-gitlab-blob-id') if response.status_code == 200 else None
+        if readme and blob_id and readme['blob_id'] == blob_id:
+            return readme_cache.store(project_id, blob_id, readme['readme_md'], readme['readme_html'])
+        response = gitlab_session_get(f'{url}/raw',
+                                      params={'id': project_id,
+                                              'file_path': readme_file,
+                                              'ref': 'HEAD'},
+                                      # the blob ID already tells if the README changed, the rendering is cached
+                                      cache=False)
+        readme_cache.count_download()
+        if response.status_code != 200:
+            log.error(f'Error downloading README of project {project_id}: status_code: {response.status_code}')
+            if readme:
+                # keep the previous rendering - its blob ID makes the next run try again
+                return readme_cache.store(project_id, readme['blob_id'], readme['readme_md'], readme['readme_html'])
+            return None
+        return readme_cache.store(project_id, blob_id, response.text, render_readme(response.text))
 
 
 def collect_project_container_image_readme(container_image: dict) -> dict:
@@ -217,73 +490,437 @@ def collect_project_container_image_readme(container_image: dict) -> dict:
     :return:
     """
     project = container_image['project']
-    project_id = project['id']
-    if project.get('readme_url'):
-        readme_file = project['readme_url'].split('/')[-1]
-        response = gitlab_session_get(
-            f'{config.api.url}{API_SUFFIX}/projects/{project_id}/repository/files/{readme_file}/raw',
-            params={'id': project_id,
-                    'file_path': readme_file,
-                    'ref': 'HEAD'})
-
-        container_image['readme_md'] = response.text
-        readme_html = markdown(response.text,
-                               extensions=['attr_list',
-                                           'def_list',
-                                           'fenced_code',
-                                           'md_in_html',
-                                           'tables'])
-        # decrease the size of headers to make the README tab more readable
-        readme_html = readme_html.replace('<h5>', '<h6>').replace('</h5>', '</h6>')
-        readme_html = readme_html.replace('<h4>', '<h6>').replace('</h4>', '</h6>')
-        readme_html = readme_html.replace('<h3>', '<h5>').replace('</h3>', '</h5>')
-        readme_html = readme_html.replace('<h2>', '<h4>').replace('</h2>', '</h4>')
-        readme_html = readme_html.replace('<h1>', '<h3>').replace('</h1>', '</h3>')
-        container_image['readme_html'] = readme_html
+    readme = collect_project_readme(project) if project.get('readme_url') else None
+    if readme:
+        container_image['readme_md'] = readme['readme_md']
+        container_image['readme_html'] = readme['readme_html']
 
     return container_image
 
 
-def collect_container_images(projects_list: list = None) -> None:
+def collect_container_images_tags(container_image: dict) -> list:
     """
-    recursively request information about projects, their container images and their respective tags
+    collector stage: add tag information - only container images which have tags are passed on
+    :param container_image:
+    :return: list of container images or None if not all tags could be retrieved
     """
-    db = couchdb.get_database_object('container_images')
+    container_image = collect_project_container_images_tag(container_image)
+    if container_image is None:
+        return None
+    if container_image['tags']:
+        log.info(f"Collected container image tags: {container_image["location"]} {sorted(container_image['tags'].keys())}")
+        return [container_image]
+    return list()
+
 
-    for project in [x for x in projects_list if x.get('container_registry_enabled')]:
-        # details of every project are to be collected one by one, only from those which
-        container_images = collect_project_container_images(project)
-        if container_images:
-            for container_image in container_images:
-                # add tag information
-                container_image = collect_project_container_images_tag(container_image)
-                # only store container images which have tags
-                if container_image['tags']:
-                    log.info(f"Collected container image tags: {container_image["location"]} {sorted(container_image['tags'].keys())}")
-                    # add last update and human-readable size information
-                    container_image = collect_project_container_image_tags_humanize(container_image)
-                    container_image = collect_project_container_image_tags_compare_revisions(container_image)
-                    container_image = collect_project_container_image_readme(container_image)
-                    # put container image info into database
-                    db.store_by_id(container_image['location'], container_image)
-                    log.info(f"Stored container image: {container_image["location"]} into database")
-
-
-def clean_container_images(projects_list: list):
-    """
-    clean up container images database
+def collect_container_images_enrich(container_image: dict) -> list:
+    """
+    collector stage: add last update, human-readable size information, revisions and README
+    :param container_image:
+    :return:
+    """
+    with stage_duration.time(stage='humanize'):
+        container_image = collect_project_container_image_tags_humanize(container_image)
+    with stage_duration.time(stage='readme'):
+        container_image = collect_project_container_image_readme(container_image)
+    return [container_image]
+
+
+def split_container_image(container_image: dict) -> tuple:
+    """
+    split the heavy parts tags and README off a container image to be stored in their own documents
+    search results and details only need the lightweight container image document
+    :param container_image:
+    :return: container image, its tags document and the README document of its project
+    """
+    container_image = dict(container_image)
+    tags = {'hash': container_image['hash'],
+            'location': container_image['location'],
+            'project_id': container_image['project_id'],
+            'registry': container_image['registry'],
+            'tags': container_image.pop('tags')}
+    # the tag list is shown newest first - sorting thousands of tags once here saves it on every page view
+    tags['tags_order'] = sort_tags(tags['tags'])
+    readme = {'project_id': container_image['project_id'],
+              'registry': container_image['registry'],
+              'readme_md': container_image.pop('readme_md', ''),
+              'readme_html': container_image.pop('readme_html', '')}
+    return container_image, tags, readme
+
+
+class Sweep:
+    """
+    marks of one collector run - everything not marked will be removed from the database afterwards
+    """
+
+    def __init__(self, shard: int = None, status=None):
+        """
+        :param shard: number of the shard of project IDs covered by this sweep, None for all projects
+        :param status: SweepStatus to report progress to
+        """
+        self.shard = shard
+        self.status = status
+        # progress - projects whose container images were listed and container images handed over for storing
+        self.projects_done = 0
+        self.container_images_done = 0
+        self.started = time()
+        # IDs of all projects found
+        self.project_ids = set()
+        # IDs of container images which still exist in GitLab
+        self.marked = set()
+        # IDs of projects owning marked container images
+        self.marked_project_ids = set()
+        # projects whose container images could not be listed must not lose their stored ones
+        self.failed_project_ids = set()
+        # False if not all projects could be found, so nothing may be cleaned up
+        self.complete = True
+        # stages mark from several threads
+        self._lock = Lock()
+
+    def mark(self, container_images: list) -> None:
+        """
+        mark container images as existing
+        :param container_images:
+        """
+        with self._lock:
+            self.marked.update(x['location'] for x in container_images)
+            self.marked_project_ids.update(x['project_id'] for x in container_images)
+
+    def fail(self, project_id: int) -> None:
+        """
+        keep all container images of a project
+        :param project_id:
+        """
+        with self._lock:
+            self.failed_project_ids.add(project_id)
+
+    def incomplete(self) -> None:
+        """
+        keep all stored container images because some projects might have been missed
+        """
+        self.complete = False
+
+    def count(self, projects: int = 0, container_images: int = 0) -> None:
+        """
+        count progress and report it
+        :param projects: number of projects done
+        :param container_images: number of container images done
+        """
+        with self._lock:
+            self.projects_done += projects
+            self.container_images_done += container_images
+        if self.status:
+            self.status.report(self, 'collecting')
+
+
+class SweepStatus:
+    """
+    progress of sweeps stored in CouchDB, to be shown by the web frontend while the database is still empty
+    """
+
+    def __init__(self, shard: int = None):
+        """
+        :param shard: number of shard, None if not sharded
+        """
+        self._database = couchdb.get_database_object('collector_status')
+        self.document_id = 'sweep' if shard is None else f'sweep-shard-{shard}'
+        previous = self._database.get_by_id(self.document_id) or dict()
+        # there is no total number of projects in advance - the previous sweep gives a good estimate
+        self.projects_expected = previous.get('projects_expected', 0) if previous.get('running') \
+            else previous.get('projects_done', 0)
+        self._written = 0
+        self._lock = Lock()
+
+    def report(self, sweep: Sweep, stage: str, force: bool = False) -> None:
+        """
+        store progress, at most every STATUS_INTERVAL seconds unless forced
+        :param sweep:
+        :param stage: current stage of the sweep
+        :param force: store in any case, e.g. at start or end
+        """
+        now = time()
+        # one thread writing the status is enough, the others do not wait for it
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            if not force and now - self._written < STATUS_INTERVAL:
+                return
+            self._written = now
+            self._database.store_by_id(self.document_id,
+                                       {'shard': sweep.shard,
+                                        'stage': stage,
+                                        'running': stage != 'finished',
+                                        'projects_done': sweep.projects_done,
+                                        'projects_expected': self.projects_expected,
+                                        'container_images_done': sweep.container_images_done,
+                                        'started': sweep.started,
+                                        'updated': now})
+        except Exception as exception:
+            log.error(f'Error storing sweep status: {exception}')
+        finally:
+            self._lock.release()
+
+
+def collect_container_images(projects=None, full_sweep: bool = True, sweep: Sweep = None) -> None:
+    """
+    request information about projects, their container images and their respective tags
+    projects flow through the stages repositories -> tags -> enrich -> store, each with its own workers
+    :param projects: iterable of projects, may be a generator
+    :param full_sweep: if False, container images whose watermark did not move since the last run are skipped
+    :param sweep: marks existing container images for the cleanup afterwards
     """
     db = couchdb.get_database_object('container_images')
-    # get documents of the current registry
-    documents = db.find(selector={'registry': config.registry}, use_index='registry')
-    # get all project IDs from the projects list
-    project_ids = [project.get('id') for project in projects_list]
-    for document in documents:
-        # delete all container images that are not part of the current projects
-        if document.get('project_id') not in project_ids:
-            log.info(f"Deleting container image {document.get('name')} from database")
-            db.delete_by_document(document)
-    log.info('Cleaned up container images database')
+    db_tags = couchdb.get_database_object('container_image_tags')
+    db_readmes = couchdb.get_database_object('project_readmes')
+    if sweep is None:
+        sweep = Sweep()
+
+    def repositories(project: dict) -> list:
+        sweep.count(projects=1)
+        try:
+            container_images = collect_project_container_images(project)
+            if container_images is None:
+                sweep.fail(project.get('id'))
+                return list()
+            # only container images with tags are stored, so only those may survive the cleanup
+            sweep.mark([x for x in container_images if x.get('tags')])
+            if full_sweep or not container_images:
+                return container_images
+            # watermarks stored with the container images of this project during previous runs
+            watermarks = {document.get('location'): document.get('watermark')
+                          for document in db.find(selector={'project_id': project.get('id')},
+                                                  use_index='project_id',
+                                                  fields=['location', 'watermark'])}
+        except Exception:
+            sweep.fail(project.get('id'))
+            raise
+        changed = [x for x in container_images if watermarks.get(x['location']) != x['watermark']]
+        if len(changed) < len(container_images):
+            log.info(f"Skipped {len(container_images) - len(changed)} unchanged container images "
+                     f"of project {project.get('id')}")
+        return changed
+
+    def tags(container_image: dict) -> list:
+        container_images = collect_container_images_tags(container_image)
+        if container_images is None:
+            # the stored documents of the project are kept as they are, cleanup included
+            sweep.fail(container_image['project_id'])
+            return list()
+        return container_images
+
+    def store_failed(database, document_id: str, document: dict, result: dict) -> None:
+        if result.get('error') == 'conflict' and document:
+            # document was changed meanwhile - store it on its own with the current revision
+            database.store_by_id(document_id, document)
+            log.info(f"Stored conflicting document: {document_id} into database")
+        else:
+            log.error(f"Error storing document {document_id}: {result.get('error')} {result.get('reason')}")
+
+    writers = [CouchDBBulkWriter(database, config.collector.bulk_size, on_error=partial(store_failed, database))
+               for database in (db, db_tags, db_readmes)]
+    writer, writer_tags, writer_readmes = writers
+
+    def store(container_image: dict) -> None:
+        # put container image info into database - written in batches
+        container_image, tags, readme = split_container_image(container_image)
+        writer.add(container_image['location'], container_image)
+        writer_tags.add(container_image['location'], tags)
+        writer_readmes.add(str(container_image['project_id']), readme)
+        log.info(f"Stored container image: {container_image["location"]} into database")
+        sweep.count(container_images=1)
+
+    def with_container_registry(projects):
+        # details are only to be collected from projects which have a container registry
+        for project in projects:
+            if project.get('container_registry_enabled'):
+                yield project
+            else:
+                sweep.count(projects=1)
+
+    workers = config.collector.workers
+    queue_size = config.collector.queue_size
+    pipeline = Pipeline([Stage('repositories', repositories, workers.repositories, queue_size),
+                         Stage('tags', tags, workers.tags, queue_size),
+                         Stage('enrich', collect_container_images_enrich, workers.enrich, queue_size),
+                         Stage('store', store, workers.store, queue_size)])
+    pipeline.run(with_container_registry(projects))
+    # write the remaining container images
+    for writer in writers:
+        writer.flush()
+
+
+def clean_container_images(sweep: Sweep):
+    """
+    clean up container images database - delete all container images of the current registry not marked by the sweep
+    together with their tags and READMEs of projects without container images
+    """
+    for database_name, is_stale in (('container_images', lambda x: x['_id'] not in sweep.marked),
+                                    ('container_image_tags', lambda x: x['_id'] not in sweep.marked),
+                                    ('project_readmes', lambda x: x.get('project_id') not in sweep.marked_project_ids)):
+        db = couchdb.get_database_object(database_name)
+        selector = {'registry': config.registry}
+        if sweep.shard is not None:
+            # documents of other shards are up to other collectors
+            selector['project_id'] = {'$mod': [config.collector.shards, sweep.shard]}
+        # only IDs and revisions are needed, not the whole documents
+        documents = db.find(selector=selector,
+                            use_index='registry',
+                            fields=['_id', '_rev', 'project_id'])
+        stale_documents = [x for x in documents
+                           if is_stale(x) and x.get('project_id') not in sweep.failed_project_ids]
+        for document in stale_documents:
+            log.info(f"Deleting {document['_id']} from database {database_name}")
+        bulk_size = config.collector.bulk_size
+        for start in range(0, len(stale_documents), bulk_size):
+            for failure in db.delete_bulk(stale_documents[start:start + bulk_size]):
+                log.error(f"Error deleting {failure.get('id')} from database {database_name}: "
+                          f"{failure.get('error')} {failure.get('reason')}")
+        log.info(f'Cleaned up database {database_name} - deleted {len(stale_documents)} documents')
+
+
+def collect_project_ids(projects, sweep: Sweep):
+    """
+    pass projects through while remembering their IDs
+    :param projects: iterable of projects
+    :param sweep: sweep to be filled with IDs
+    :return: generator of projects
+    """
+    for project in projects:
+        sweep.project_ids.add(project.get('id'))
+        yield project
+
+
+def in_shard(projects, shard: int):
+    """
+    pass only projects whose ID belongs to a shard
+    :param projects: iterable of projects
+    :param shard: number of shard
+    :return: generator of projects
+    """
+    for project in projects:
+        if isinstance(project.get('id'), int) and project['id'] % config.collector.shards == shard:
+            yield project
+
+
+def sweep_projects(full_sweep: bool = True, shard: int = None) -> None:
+    """
+    collect container images and clean up the ones not existing anymore
+    :param full_sweep: if False, unchanged container images are skipped
+    :param shard: only sweep projects of this shard, None for all projects
+    """
+    log.info('Collecting projects...' if full_sweep else 'Collecting projects incrementally...')
+    status = SweepStatus(shard)
+    sweep = Sweep(shard, status)
+    status.report(sweep, 'collecting', force=True)
+    if config.collector.groups:
+        # only projects with container images in the configured groups, already filtered by shard
+        projects = collect_group_projects(config.collector.groups, sweep)
+    else:
+        projects = collect_projects()
+        if shard is not None:
+            projects = in_shard(projects, shard)
+    if shard is not None:
+        log.info(f'Collecting shard {shard} of {config.collector.shards}')
+    readme_cache.new_run()
+    # get details of container images of all projects while the projects are still being listed
+    collect_container_images(collect_project_ids(projects, sweep), full_sweep, sweep)
+    if not sweep.complete:
+        log.error('Not all groups could be listed - skipping clean up')
+    elif sweep.project_ids:
+        # clean up container images database - delete not anymore existing container images
+        status.report(sweep, 'cleaning', force=True)
+        clean_container_images(sweep)
+    if full_sweep and sweep.complete:
+        # READMEs of other shards are left to their sweeps
+        pruned = readme_cache.prune(None if shard is None else lambda x: x % config.collector.shards == shard)
+        if pruned:
+            log.info(f'Forgot READMEs of {pruned} projects not swept anymore')
+    status.report(sweep, 'finished', force=True)
+    log.info(f'HTTP cache: {len(response_cache)} responses, '
+             f'{response_cache.hits} hits, {response_cache.misses} misses')
+    log.info(f'README cache: {len(readme_cache)} projects, {readme_cache.downloads} downloads')
+    duration = time() - sweep.started
+    shard_label = '' if shard is None else shard
+    sweep_duration.set(duration, shard=shard_label)
+    sweep_container_images.set(sweep.container_images_done, shard=shard_label)
+    sweep_items_per_second.set(sweep.container_images_done / duration if duration else 0, shard=shard_label)
+    sweep_finished.set(time(), shard=shard_label)
+    log.info(f'Swept {sweep.projects_done} projects and {sweep.container_images_done} container images '
+             f'in {duration:.1f} seconds')
+    if config.collector.metrics.textfile:
+        registry.write_textfile(config.collector.metrics.textfile)
+
+
+def refresh_projects(references: list) -> None:
+    """
+    refresh container images of single projects as requested by webhooks
+    deleted container images are left to the cleanup of the next sweep
+    :param references: list of project IDs and repository paths
+    """
+    projects = dict()
+    for reference in references:
+        if isinstance(reference, int):
+            project = collect_project(reference)
+        else:
+            project = collect_project_of_repository(reference)
+        if project:
+            # several repositories of one project need only one refresh
+            projects[project['id']] = project
+        else:
+            log.error(f'Could not find project of {reference} to refresh')
+    if projects:
+        log.info(f'Refreshing projects {sorted(projects.keys())}')
+        # pushes might have changed the README - a new run would make a running sweep check all READMEs again
+        readme_cache.expire(projects.keys())
+        collect_container_images(list(projects.values()), full_sweep=True)
+
+
+def start_webhook_server() -> WebhookServer:
+    """
+    listen for webhooks to refresh projects between sweeps - only with a secret token
+    :return: server or None if no token is configured
+    """
+    webhook = config.collector.webhook
+    if not webhook.token:
+        # anybody able to reach the port could make the collector hammer GitLab
+        log.error('Not listening for webhooks - collector.webhook.token has to be set')
+        return None
+    queue = RefreshQueue(refresh_projects, debounce=webhook.debounce, max_delay=webhook.max_delay)
+    queue.start()
+    server = WebhookServer(queue, address=webhook.address, port=webhook.port, token=webhook.token)
+    server.start()
+    return server
+
+
+def run_sharded_collector():
+    """
+    run one of several collectors in a loop - every shard is swept by whoever claims it first
+    :return:
+    """
+    leases = ShardLeases(couchdb.get_database_object('collector_leases'),
+                         shards=config.collector.shards,
+                         ttl=config.collector.lease_ttl,
+                         interval=config.update_interval)
+    log.info(f'Collector {leases.owner} sharing {leases.shards} shards')
+    while True:
+        swept = False
+        for shard in leases.due_shards():
+            lease = leases.claim(shard)
+            if not lease:
+                continue
+            # incremental runs skip unchanged container images, a regular full sweep is the safety net
+            full_sweep = not config.collector.incremental or \
+                         time() - lease['full_swept'] >= config.collector.full_sweep_interval
+            try:
+                with leases.lease(shard, full_sweep):
+                    sweep_projects(full_sweep, shard)
+                swept = True
+            except Exception as exception:
+                # one failed shard must not stop the collector
+                log.error(f'Error sweeping shard {shard}: {exception}')
+        if not swept:
+            # look again soon - shards become due at different times and leases of crashed collectors expire
+            sleep(min(LEASE_POLL_INTERVAL, config.update_interval))
 
 
 def run_collector():
@@ -291,13 +928,20 @@ def run_collector():
     run the collector in a loop
     :return:
     """
+    if config.collector.metrics.port:
+        registry.serve(config.collector.metrics.address, config.collector.metrics.port)
+    if config.collector.webhook.port:
+        start_webhook_server()
+    if config.collector.shards > 1:
+        run_sharded_collector()
+    # the first run after start is always a full one
+    last_full_sweep = None
     while True:
-        log.info('Collecting projects...')
-        # get list of projects
-        projects_list = collect_projects()
-        if projects_list:
-            # get details of container images of all projects
-            collect_container_images(projects_list)
-            # clean up container images database - delete not anymore existing container images
-            clean_container_images(projects_list)
+        # incremental runs skip unchanged container images, a regular full sweep is the safety net
+        full_sweep = not config.collector.incremental or \
+                     last_full_sweep is None or \
+                     monotonic() - last_full_sweep >= config.collector.full_sweep_interval
+        if full_sweep:
+            last_full_sweep = monotonic()
+        sweep_projects(full_sweep)
         sleep(config.update_interval)
@@ -11,6 +11,77 @@ from yaml.scanner import ScannerError
 API_SUFFIX = '/api/v4'
 TIMEOUT = 60
 
+# defaults for the optional 'collector' section of the config file
+COLLECTOR_DEFAULTS = {
+    # number of tag details requested in parallel per container image - 1 means sequential
+    'tag_concurrency': 1,
+    # number of worker threads per collector stage
+    'workers': {'repositories': 2,
+                'tags': 2,
+                'enrich': 2,
+                'store': 1},
+    # maximal number of items waiting between collector stages
+    'queue_size': 100,
+    # only collect details of container images whose watermark moved since the last run
+    'incremental': False,
+    # seconds between full sweeps when collecting incrementally
+    'full_sweep_interval': 86400,
+    # number of GitLab listings kept for conditional requests, 0 disables the cache
+    # has to exceed the number of listings requested per sweep, otherwise the LRU evicts them before they are reused
+    'http_cache_size': 10000,
+    # maximal requests per second to GitLab, 0 leaves it to the rate limit headers sent by GitLab
+    'rate_limit': 0,
+    # number of retries of a failed request to GitLab
+    'retries': 5,
+    # number of container images written to CouchDB in one batch
+    'bulk_size': 50,
+    # IDs or paths of groups whose container registries are listed to find projects with container images,
+    # empty lists all projects of the instance
+    'groups': [],
+    # number of shards the project IDs are split into, to be claimed by several collector processes
+    'shards': 1,
+    # seconds until the lease of a shard expires if its collector stops renewing it
+    'lease_ttl': 300,
+    # receiver of GitLab webhooks and registry notifications to refresh single projects between sweeps
+    'webhook': {'port': 0,
+                'address': '0.0.0.0',
+                # secret expected with every request - the receiver does not start without it
+                'token': '',
+                # seconds without further events before a project is refreshed
+                'debounce': 5,
+                # seconds after which a project is refreshed even if events keep coming
+                'max_delay': 60},
+    # metrics in Prometheus text format - served at /metrics if port is set, written after every sweep if textfile is set
+    'metrics': {'port': 0,
+                'address': '0.0.0.0',
+                'textfile': ''}
+}
+
+# defaults for the optional 'web' section of the config file
+WEB_DEFAULTS = {
+    # number of documents per database kept for container image pages, 0 disables the cache
+    'document_cache_size': 1000,
+    # minimal size in bytes of responses to be compressed, 0 disables compression
+    'compression_min_size': 1024
+}
+
+
+def merge_defaults(defaults: dict, values: dict) -> dict:
+    """
+    merge configured values into defaults, recursively for nested sections
+    :param defaults: default values
+    :param values: values from config file
+    :return: merged dictionary
+    """
+    merged = dict(defaults)
+    for key, value in (values or dict()).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_defaults(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
 def load_config(args):
     """
     load YAML config file
@@ -26,6 +97,11 @@ def load_config(args):
     else:
         exit(f"'{args.config_file}' does not exist or is no file")
 
+    # fill optional collector settings with defaults
+    config['collector'] = munchify(merge_defaults(COLLECTOR_DEFAULTS, config.get('collector')))
+    # fill optional web settings with defaults
+    config['web'] = munchify(merge_defaults(WEB_DEFAULTS, config.get('web')))
+
     # add commandline arguments
     for key, value in args.__dict__.items():
         if not key in config.__dict__.keys():
@@ -1,11 +1,27 @@
+from collections import OrderedDict
+from random import uniform
 from ssl import PROTOCOL_TLS_CLIENT
+from threading import Lock
+from time import perf_counter, \
+    sleep, \
+    time
+from urllib.parse import urlsplit
 
-from httpx import Client, Response
+from httpx import Client, Limits, Response
 from truststore import SSLContext
 
 from backend.config import config, \
     TIMEOUT
 from backend.helpers import log
+from backend.metrics import endpoint_of, \
+    gitlab_request_duration, \
+    gitlab_requests
+
+# status codes worth another try - 999 is used for exceptions during access
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504, 999]
+# base and maximum of exponential backoff in seconds
+BACKOFF_BASE = 1
+BACKOFF_MAXIMUM = 60
 
 # disable TLS verification if configured
 if config.api.get('verify', True) == False:
@@ -13,23 +29,257 @@ if config.api.get('verify', True) == False:
 else:
     # use system trust store for TLS verification
     verify = SSLContext(PROTOCOL_TLS_CLIENT)
-gitlab_session = Client(follow_redirects=True, verify=verify)
+# concurrent GitLab requests of a sweep - every tags worker runs up to tag_concurrency requests at once, the other
+# stages one each plus the listing of projects
+workers = config.collector.workers
+concurrency = workers.repositories + workers.tags * config.collector.tag_concurrency + workers.enrich + 1
+if config.collector.webhook.port:
+    # refreshes run their own stages next to a sweep
+    concurrency *= 2
+# a pool smaller than the concurrency would make requests wait for connections instead of GitLab
+limits = Limits(max_connections=max(100, concurrency), max_keepalive_connections=max(20, concurrency))
+gitlab_session = Client(follow_redirects=True, verify=verify, limits=limits)
 
 # add GitLab API token to session headers
 # this is needed for all requests to the GitLab API
 gitlab_session.headers.update({'PRIVATE-TOKEN': config.api.token})
 
 
-def gitlab_session_get(url, params=None) -> Response:
+class ResponseCache:
+    """
+    size-bounded LRU cache of GitLab responses which carry validators for conditional requests
+    """
+
+    def __init__(self, size: int = 0):
+        """
+        :param size: maximal number of cached responses, 0 disables the cache
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+        # requests may run in parallel threads
+        self._lock = Lock()
+
+    @staticmethod
+    def key(url, params=None) -> tuple:
+        """
+        key of a request consisting of URL and parameters
+        :param url:
+        :param params:
+        :return:
+        """
+        return url, tuple(sorted((str(key), str(value)) for key, value in (params or dict()).items()))
+
+    def get(self, key) -> Response:
+        """
+        get cached response and mark it as recently used
+        :param key:
+        :return: response or None
+        """
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+            return response
+
+    def store(self, key, response: Response) -> None:
+        """
+        store response if it can be validated later, the least recently used ones are evicted
+        :param key:
+        :param response:
+        """
+        if not self.size or \
+                response.status_code != 200 or \
+                not (response.headers.get('etag') or response.headers.get('last-modified')):
+            return
+        # only headers and decoded body are kept, not the request and connection details
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name not in ('content-encoding', 'content-length')]
+        response = Response(response.status_code, headers=headers, content=response.content)
+        with self._lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.size:
+                self._responses.popitem(last=False)
+
+    def count(self, hit: bool) -> None:
+        """
+        count hit or miss
+        :param hit:
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def __len__(self):
+        return len(self._responses)
+
+
+response_cache = ResponseCache(config.collector.http_cache_size)
+
+
+class RequestScheduler:
+    """
+    token bucket for requests to GitLab, fed by its RateLimit-* and Retry-After headers
+    """
+
+    def __init__(self, rate: float = 0):
+        """
+        :param rate: configured maximum of requests per second, 0 means only limits announced by GitLab count
+        """
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time()
+        # no requests at all before this point in time
+        self.blocked_until = 0
+        self._lock = Lock()
+
+    def _refill(self, now: float) -> None:
+        """
+        add tokens for the time passed since the last refill
+        :param now:
+        """
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = self.capacity
+        self.updated = now
+
+    def acquire(self) -> None:
+        """
+        wait until a request may be sent
+        """
+        while True:
+            with self._lock:
+                now = time()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.rate else 0)
+            sleep(max(wait, 0.01))
+
+    def block(self, seconds: float) -> None:
+        """
+        pause all requests for some time
+        :param seconds:
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time() + seconds)
+
+    def update(self, response: Response) -> None:
+        """
+        adapt to the rate limit announced by GitLab
+        :param response:
+        """
+        headers = response.headers
+        try:
+            with self._lock:
+                if headers.get('ratelimit-limit'):
+                    # GitLab announces its limit per minute - never be faster than configured
+                    rate = int(headers['ratelimit-limit']) / 60
+                    self.rate = min(self.rate, rate) if self.rate else rate
+                    self.capacity = max(1.0, self.rate)
+                if headers.get('ratelimit-remaining'):
+                    remaining = int(headers['ratelimit-remaining'])
+                    self.tokens = min(self.tokens, remaining)
+                    if remaining <= 0 and headers.get('ratelimit-reset'):
+                        # wait until the limit gets reset - the header is a unix timestamp
+                        self.blocked_until = max(self.blocked_until, float(headers['ratelimit-reset']))
+        except ValueError as exception:
+            log.error(f'Invalid rate limit headers from GitLab: {exception}')
+
+    def backoff(self, attempt: int, response: Response = None) -> float:
+        """
+        delay before next attempt - GitLab's Retry-After wins, otherwise exponential backoff with full jitter
+        :param attempt: number of the failed attempt, starting with 0
+        :param response: failed response
+        :return: delay in seconds
+        """
+        if response is not None and response.headers.get('retry-after'):
+            try:
+                delay = float(response.headers['retry-after'])
+                # a 429 concerns all requests, not only this one
+                self.block(delay)
+                return delay
+            except ValueError:
+                pass
+        return uniform(0, min(BACKOFF_MAXIMUM, BACKOFF_BASE * 2 ** attempt))
+
+
+request_scheduler = RequestScheduler(config.collector.rate_limit)
+
+
+def gitlab_session_request(method: str, url, params=None, headers=None) -> Response:
+    """
+    request to GitLab API with session, retried with backoff - important with exception handling
+    :param method: HTTP method
+    :param url: URL to request
+    :param params: optional parameters for the request
+    :param headers: optional additional headers
+    :return: response object
+    """
+    retries = config.collector.retries
+    for attempt in range(retries + 1):
+        request_scheduler.acquire()
+        start = perf_counter()
+        try:
+            response = gitlab_session.request(method, url, params=params, headers=headers, timeout=TIMEOUT)
+        except Exception as exception:
+            # if an exception occurs, return a response with status code 999 to indicate an unknown error
+            log.error(f'Exception during access to GitLab: {exception}')
+            response = Response(999, text=str(exception))
+        endpoint = endpoint_of(urlsplit(str(url)).path)
+        gitlab_request_duration.observe(perf_counter() - start, method=method, endpoint=endpoint)
+        gitlab_requests.inc(method=method, endpoint=endpoint, status=response.status_code)
+        request_scheduler.update(response)
+        if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+            break
+        delay = request_scheduler.backoff(attempt, response)
+        log.warning(f'status_code: {response.status_code} for {url} - attempt {attempt + 1} of {retries + 1}, '
+                    f'retrying in {delay:.1f} seconds')
+        sleep(delay)
+    return response
+
+
+def gitlab_session_get(url, params=None, cache=True) -> Response:
     """
     GET request to GitLab API with session - important with exception handling
     :param url: URL to request
     :param params: optional parameters for the request
+    :param cache: use conditional requests and deliver cached response if GitLab reports it as not modified
+    :return: response object
+    """
+    key = ResponseCache.key(url, params)
+    cached_response = response_cache.get(key) if cache else None
+    headers = dict()
+    if cached_response is not None:
+        if cached_response.headers.get('etag'):
+            headers['If-None-Match'] = cached_response.headers['etag']
+        if cached_response.headers.get('last-modified'):
+            headers['If-Modified-Since'] = cached_response.headers['last-modified']
+    response = gitlab_session_request('GET', url, params=params, headers=headers)
+    if response.status_code == 999:
+        return response
+    if cache:
+        if cached_response is not None and response.status_code == 304:
+            # not modified - no need to download the body again
+            response_cache.count(hit=True)
+            return cached_response
+        response_cache.count(hit=False)
+        response_cache.store(key, response)
+    return response
+
+
+def gitlab_session_head(url, params=None) -> Response:
+    """
+    HEAD request to GitLab API with session, e.g. to get file metadata without its content
+    :param url: URL to request
+    :param params: optional parameters for the request
     :return: response object
     """
-    try:
-        return gitlab_session.get(url, params=params, timeout=TIMEOUT)
-    except Exception as exception:
-        # if an exception occurs, return a response with status code 999 to indicate an unknown error
-        log.error(f'Exception during access to GitLab: {exception}')
-        return Response(999, text=str(exception))
+    return gitlab_session_request('HEAD', url, params=params)
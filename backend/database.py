@@ -1,15 +1,27 @@
 from datetime import datetime
+from hashlib import sha256
+from json import dumps
+from threading import Lock, \
+    Thread
 from time import sleep
 from urllib.parse import quote
 
 from couchdb3 import Document, \
     Server
 from dateutil.relativedelta import relativedelta
-from deepdiff import DeepDiff
 
 from backend.config import config, \
     TIMEOUT
 from backend.helpers import log
+from backend.metrics import couchdb_documents
+
+# milliseconds to wait for changes in a single longpoll request - has to be shorter than the request timeout
+CHANGES_TIMEOUT = 30000
+# fields which do not count as change of a document - volatile ones are derived from the time of collection
+FINGERPRINT_IGNORED_FIELDS = {'_id', '_rev', 'fingerprint', 'age_human_readable', 'created'}
+# view delivering the fingerprints of documents by their IDs, without loading the documents
+FINGERPRINT_DESIGN = 'fingerprint'
+FINGERPRINT_VIEWS = {'fingerprint': {'map': 'function (doc) { if (doc.fingerprint) { emit(doc._id, doc.fingerprint); } }'}}
 
 
 class CouchDBDatabase:
@@ -32,11 +44,55 @@ class CouchDBDatabase:
                                   ddoc='path')
         self._database.save_index(index={'fields': ['registry']},
                                   ddoc='registry')
+        self._database.save_index(index={'fields': ['project_id']},
+                                  ddoc='project_id')
+        self.save_design(FINGERPRINT_DESIGN, FINGERPRINT_VIEWS)
 
-    def store_by_id(self, document_id: str, document_content: dict) -> Document:
-        # quoting is necessary to avoid IDs being cut of at '/'s
-        document_id_quoted = quote(document_id, safe='')
-        document = self._database.get(document_id_quoted)
+    def save_design(self, name: str, views: dict) -> None:
+        """
+        Create or update a design document with views, unless it exists already as it is.
+        :param name: name of the design document
+        :param views: views by name
+        """
+        design = self._database.get_design(name)
+        if design and design.get('views') == views:
+            return
+        try:
+            self._database.put_design(name, rev=design.get('_rev') if design else None, views=views)
+        except Exception as exception:
+            # another process starting at the same time might have been faster
+            log.warning(f'Could not save design document {name} of database {self._name}: {exception}')
+
+    def post_keys(self, resource: str, keys: list, include_docs: bool = False) -> list:
+        """
+        Query a view by many keys - they are posted in the request body, as they would exceed the length of an URL.
+        :param resource: view like '_all_docs' or '_design/name/_view/name'
+        :param keys: keys to look up
+        :param include_docs: add the whole documents to the rows as 'doc'
+        :return: rows of the view
+        """
+        return self._database._post(resource=resource,
+                                    body={'keys': keys},
+                                    query_kwargs={'include_docs': include_docs} if include_docs else None) \
+            .json().get('rows', list())
+
+    def get_by_ids(self, document_ids: list) -> list:
+        """
+        Get documents by their IDs - unlike a Mango query with '$in' only these documents are read.
+        :param document_ids:
+        :return: list of existing documents in the order of the IDs
+        """
+        if not document_ids:
+            return list()
+        return [x['doc'] for x in self.post_keys('_all_docs', document_ids, include_docs=True) if x.get('doc')]
+
+    @staticmethod
+    def serialize(document_content: dict) -> dict:
+        """
+        Convert values which cannot be stored as JSON.
+        :param document_content: content of a document, converted in place
+        :return: converted content
+        """
         for key, value in document_content.items():
             if isinstance(value, datetime):
                 # convert datetime to string
@@ -44,28 +100,129 @@ class CouchDBDatabase:
             elif isinstance(value, relativedelta):
                 # convert datetime to string
                 document_content[key] = str(value)
+        return document_content
 
-        if document:
-            document_as_dict = dict(document)
-            diff = DeepDiff(document_as_dict, document_content, ignore_order=True)
-            if diff.get('values_changed') or \
-                    diff.get('affected_root_keys') and \
-                    set(diff.affected_root_keys) != {'_id', '_rev'} or \
-                    document.keys() != document_content.keys():
-                document.update({**{'_id': document_id_quoted}, **document_content})
-                self._database.save(document)
+    @staticmethod
+    def fingerprint(document_content: dict) -> str:
+        """
+        Stable hash of the content of a document, used to detect changes without loading the stored document.
+        :param document_content: serialized content of a document
+        :return: SHA-256 of the canonical JSON of all non-volatile fields
+        """
+        content = {key: value for key, value in document_content.items()
+                   if key not in FINGERPRINT_IGNORED_FIELDS}
+        return sha256(dumps(content, sort_keys=True, separators=(',', ':'), default=str).encode()).hexdigest()
+
+    def store_by_id(self, document_id: str, document_content: dict) -> Document:
+        """
+        Store a single document if its content changed.
+        :param document_id: ID of the document
+        :param document_content: content of the document
+        :return: document as stored
+        """
+        failures = self.store_bulk({document_id: document_content})
+        if failures:
+            log.error(f"Error storing document {document_id}: {failures[0].get('error')} {failures[0].get('reason')}")
+        return Document(**{'_id': document_id, **document_content})
+
+    def store_bulk(self, documents: dict) -> list:
+        """
+        Store many documents at once - revisions of existing documents are looked up in _all_docs and their
+        fingerprints in a view, both by keys, and all changed documents are written by one _bulk_docs request.
+        :param documents: dictionary of document IDs and their contents
+        :return: results of documents which could not be written, e.g. because of conflicts
+        """
+        if not documents:
+            return list()
+        # IDs are part of the request body here, so no quoting is needed
+        document_ids = list(documents.keys())
+        # deleted documents come with a revision too, but are written like new ones
+        revisions = {x['id']: x['value']['rev'] for x in self.post_keys('_all_docs', document_ids)
+                     if 'value' in x and not x['value'].get('deleted')}
+        fingerprints = dict()
+        if revisions:
+            rows = self.post_keys(f'_design/{FINGERPRINT_DESIGN}/_view/fingerprint', list(revisions.keys()))
+            fingerprints = {x['id']: x['value'] for x in rows}
+        bulk = list()
+        for document_id, document_content in documents.items():
+            self.serialize(document_content)
+            document_content['fingerprint'] = self.fingerprint(document_content)
+            if document_id in revisions:
+                # unchanged content needs no write at all
+                if fingerprints.get(document_id) != document_content['fingerprint']:
+                    bulk.append({**document_content, '_id': document_id, '_rev': revisions[document_id]})
+            else:
+                bulk.append({**document_content, '_id': document_id})
+        couchdb_documents.inc(len(documents) - len(bulk), database=self._name, result='skipped')
+        if not bulk:
+            return list()
+        failures = [result for result in self._database.bulk_docs(bulk) if result.get('error')]
+        couchdb_documents.inc(len(bulk) - len(failures), database=self._name, result='written')
+        couchdb_documents.inc(len(failures), database=self._name, result='failed')
+        return failures
+
+    def store_if_unchanged(self, document_id: str, document_content: dict, revision: str = None) -> bool:
+        """
+        Store a single document only if its stored revision is still the given one - CouchDB rejects the write
+        with a conflict otherwise, which makes it usable for coordination between processes.
+        :param document_id: ID of the document
+        :param document_content: content of the document
+        :param revision: revision the content is based on, None for a new document
+        :return: True if the document was written
+        """
+        document = {**document_content, '_id': document_id}
+        if revision:
+            document['_rev'] = revision
         else:
-            self._database.save({**{'_id': document_id_quoted}, **document_content})
-        return self._database.get(document_id)
+            document.pop('_rev', None)
+        results = self._database.bulk_docs([document])
+        return bool(results) and not results[0].get('error')
 
-    def find(self, selector=dict(), use_index=None):
+    def get_by_id(self, document_id: str) -> Document:
+        """
+        Get a single document.
+        :param document_id: ID of the document
+        :return: document or None if it does not exist
+        """
+        # quoting is necessary to avoid IDs being cut of at '/'s
+        return self._database.get(quote(document_id, safe=''))
+
+    def find(self, selector=dict(), use_index=None, fields=None):
         result = self._database.find(selector=selector,
                                      use_index=use_index,
+                                     fields=fields,
                                      limit=99999999)
         if 'warning' in result:
             print(result['warning'])
         return result.get('docs', list())
 
+    def update_seq(self) -> str:
+        """
+        Get the current update sequence of the database.
+        :return: update sequence
+        """
+        return self._database.info().get('update_seq')
+
+    def changes(self, since: str = 'now', timeout: int = CHANGES_TIMEOUT) -> dict:
+        """
+        Wait for changes since an update sequence via longpoll.
+        :param since: update sequence to start after
+        :param timeout: milliseconds to wait for changes
+        :return: dictionary with 'results' and 'last_seq'
+        """
+        return self._database.changes(feed='longpoll', since=since, timeout=timeout)
+
+    def delete_bulk(self, documents: list) -> list:
+        """
+        Delete many documents by one _bulk_docs request.
+        :param documents: documents containing at least '_id' and '_rev'
+        :return: results of documents which could not be deleted
+        """
+        if not documents:
+            return list()
+        bulk = [{'_id': document['_id'], '_rev': document['_rev'], '_deleted': True} for document in documents]
+        return [result for result in self._database.bulk_docs(bulk) if result.get('error')]
+
     def delete_by_document(self, document):
         """
         Delete a document from the database.
@@ -83,6 +240,110 @@ class CouchDBDatabase:
 
 
 
+class CouchDBBulkWriter:
+    """
+    Buffer documents and write them in batches to a CouchDBDatabase.
+    """
+
+    def __init__(self, database: CouchDBDatabase, size: int = 50, on_error=None):
+        """
+        :param database: CouchDBDatabase to write into
+        :param size: number of documents written per batch
+        :param on_error: called with document ID, content and CouchDB result for every document which failed
+        """
+        self._database = database
+        self._size = max(1, size)
+        self._on_error = on_error
+        self._documents = dict()
+        # documents may be added from several threads
+        self._lock = Lock()
+
+    def add(self, document_id: str, document_content: dict) -> None:
+        """
+        Add a document to the buffer, which gets written when full.
+        :param document_id:
+        :param document_content:
+        """
+        with self._lock:
+            self._documents[document_id] = document_content
+            if len(self._documents) < self._size:
+                return
+            documents, self._documents = self._documents, dict()
+        self._write(documents)
+
+    def flush(self) -> None:
+        """
+        Write all buffered documents.
+        """
+        with self._lock:
+            documents, self._documents = self._documents, dict()
+        self._write(documents)
+
+    def _write(self, documents: dict) -> None:
+        """
+        Write documents and report failures.
+        :param documents: dictionary of document IDs and their contents
+        """
+        try:
+            failures = self._database.store_bulk(documents)
+        except Exception as exception:
+            log.error(f'Error writing {len(documents)} documents: {exception}')
+            failures = [{'id': document_id, 'error': 'exception', 'reason': str(exception)}
+                        for document_id in documents]
+        for failure in failures:
+            if self._on_error:
+                self._on_error(failure['id'], documents.get(failure['id']), failure)
+            else:
+                log.error(f"Error writing document {failure['id']}: {failure.get('error')} {failure.get('reason')}")
+
+
+class CouchDBChangesFollower:
+    """
+    Follow the _changes feed of a CouchDBDatabase in a background thread and pass changed document IDs to subscribers.
+    """
+
+    def __init__(self, database: CouchDBDatabase, since: str = 'now'):
+        """
+        :param database: CouchDBDatabase to follow
+        :param since: update sequence to start after
+        """
+        self._database = database
+        self.since = since
+        self._subscribers = list()
+        self._thread = None
+
+    def subscribe(self, callback) -> None:
+        """
+        Register a callback which receives lists of changes, each with 'id' and optionally 'deleted'.
+        :param callback:
+        """
+        self._subscribers.append(callback)
+
+    def start(self) -> None:
+        """
+        Start following in a daemon thread - only once.
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._follow, name='changes', daemon=True)
+            self._thread.start()
+
+    def _follow(self) -> None:
+        while True:
+            try:
+                result = self._database.changes(since=self.since)
+                changes = [x for x in result.get('results', list()) if x.get('id')]
+                if changes:
+                    for callback in self._subscribers:
+                        try:
+                            callback(changes)
+                        except Exception as exception:
+                            log.error(f'Error processing database changes: {exception}')
+                self.since = result.get('last_seq', self.since)
+            except Exception as exception:
+                log.error(f'Error following database changes: {exception}')
+                sleep(10)
+
+
 class CouchDBServer:
 
     # connect to CouchDB server
@@ -28,6 +28,37 @@ def plural_or_not(count: int, word: str) -> str:
         return f'{count} {word}'
 
 
+def humanize_age(age) -> str:
+    """
+    get a human-readable version of an age, only the biggest unit counts
+    :param age: relativedelta between now and some point in the past
+    :return:
+    """
+    age_human_readable = 'n/a'
+    if age.years > 0:
+        age_human_readable = f'{plural_or_not(age.years, "year")}'
+    elif age.months > 0:
+        age_human_readable = f'{plural_or_not(age.months, "month")}'
+    elif age.weeks > 0:
+        age_human_readable = f'{plural_or_not(age.weeks, "week")}'
+    elif age.days > 0:
+        age_human_readable = f'{plural_or_not(age.days, "day")}'
+    elif age.hours > 0:
+        age_human_readable = f'{plural_or_not(age.hours, "hour")}'
+    elif age.seconds > 0:
+        age_human_readable = f'{plural_or_not(age.seconds, "second")}'
+    return age_human_readable
+
+
+def sort_tags(tags: dict) -> list:
+    """
+    get tag names ordered by creation, newest first
+    :param tags: tags by name
+    :return: list of tag names
+    """
+    return sorted(tags, key=lambda x: tags[x].get('created_at') or '', reverse=True)
+
+
 def exit(message='', code=1):
     """
     exit with message and code
@@ -0,0 +1,251 @@
+# metrics of the collector in Prometheus text format, served via HTTP and/or written to a textfile
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, \
+    ThreadingHTTPServer
+from os import replace
+from pathlib import Path
+from threading import Lock, \
+    Thread
+from time import perf_counter
+
+from backend.helpers import log
+
+# upper bounds of histogram buckets in seconds, from fast CouchDB requests up to slow GitLab API pages
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# names in GitLab API paths which are followed by an ID or name
+ENDPOINT_COLLECTIONS = {'projects', 'groups', 'repositories', 'tags', 'files', 'users'}
+
+
+class Metric:
+    """
+    metric with optional labels - every combination of label values has its own value
+    """
+    type = ''
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        """
+        :param name: name of the metric
+        :param description: shown as HELP
+        :param labels: names of labels
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = dict()
+        # metrics are updated from many threads
+        self._lock = Lock()
+
+    def key(self, labels: dict) -> tuple:
+        """
+        label values in order of label names
+        :param labels:
+        :return:
+        """
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def format_labels(self, key: tuple, extra: dict = None) -> str:
+        """
+        labels in exposition format like {endpoint="/projects",status="200"}
+        :param key: label values
+        :param extra: additional labels like 'le' of histograms
+        :return:
+        """
+        pairs = list(zip(self.labels, key)) + list((extra or dict()).items())
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def samples(self) -> list:
+        """
+        lines of samples
+        :return:
+        """
+        with self._lock:
+            return [f'{self.name}{self.format_labels(key)} {value}' for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        """
+        metric in exposition format
+        :return:
+        """
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} {self.type}'] + self.samples()
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+        :param name: name of the metric
+        :param description: shown as HELP
+        :param labels: names of labels
+        :param buckets: upper bounds of buckets
+        """
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        count value in its bucket
+        :param value:
+        :param labels:
+        """
+        key = self.key(labels)
+        with self._lock:
+            # counts per bucket, sum and count
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        observe duration of a block
+        :param labels:
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        lines = list()
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{self.format_labels(key, {"le": str(bound)})} {bucket_count}')
+                lines.append(f'{self.name}_bucket{self.format_labels(key, {"le": "+Inf"})} {count}')
+                lines.append(f'{self.name}_sum{self.format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{self.format_labels(key)} {count}')
+        return lines
+
+
+class Registry:
+    """
+    all metrics to be exposed
+    """
+
+    def __init__(self):
+        self._metrics = list()
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        all metrics in Prometheus text exposition format
+        :return:
+        """
+        return '\n'.join(x.render() for x in self._metrics) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        """
+        write metrics to a file to be picked up e.g. by the textfile collector of node_exporter
+        the file is replaced atomically, so it is never read half-written
+        :param path:
+        """
+        temporary = Path(f'{path}.tmp')
+        try:
+            temporary.write_text(self.render())
+            replace(temporary, path)
+        except OSError as exception:
+            log.error(f'Error writing metrics to {path}: {exception}')
+
+    def serve(self, address: str = '0.0.0.0', port: int = 9100) -> ThreadingHTTPServer:
+        """
+        serve metrics at /metrics in a daemon thread
+        :param address:
+        :param port:
+        :return:
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        log.info(f'Serving metrics at port {server.server_address[1]}')
+        return server
+
+
+def endpoint_of(path: str) -> str:
+    """
+    endpoint of a GitLab API path without IDs and names, to keep the number of label values small
+    e.g. /api/v4/projects/12/registry/repositories/3/tags/latest -> /projects/:id/registry/repositories/:id/tags/:id
+    :param path: path of URL
+    :return:
+    """
+    parts = path.split('/api/v4', 1)[-1].strip('/').split('/')
+    endpoint = list()
+    for index, part in enumerate(parts):
+        # every other part after a collection is an ID, a file path ends the endpoint
+        if index > 0 and parts[index - 1] in ENDPOINT_COLLECTIONS and endpoint[-1] != ':id':
+            endpoint.append(':id')
+            if parts[index - 1] == 'files':
+                # file paths may contain further parts
+                if parts[-1] == 'raw' and index < len(parts) - 1:
+                    endpoint.append('raw')
+                break
+        else:
+            endpoint.append(part)
+    return '/' + '/'.join(endpoint)
+
+registry = Registry()
+
+gitlab_requests = registry.register(
+    Counter('gitlab_requests_total', 'Requests to the GitLab API', ('method', 'endpoint', 'status')))
+gitlab_request_duration = registry.register(
+    Histogram('gitlab_request_duration_seconds', 'Duration of requests to the GitLab API', ('method', 'endpoint')))
+stage_duration = registry.register(
+    Histogram('collector_stage_duration_seconds', 'Duration of collector stages per item', ('stage',)))
+couchdb_documents = registry.register(
+    Counter('couchdb_documents_total', 'Documents passed to CouchDB by result', ('database', 'result')))
+sweep_duration = registry.register(
+    Gauge('collector_sweep_duration_seconds', 'Duration of the last sweep', ('shard',)))
+sweep_container_images = registry.register(
+    Gauge('collector_sweep_container_images', 'Container images collected by the last sweep', ('shard',)))
+sweep_items_per_second = registry.register(
+    Gauge('collector_sweep_container_images_per_second', 'Container images per second of the last sweep', ('shard',)))
+sweep_finished = registry.register(
+    Gauge('collector_sweep_finished_timestamp_seconds', 'Unix time the last sweep finished', ('shard',)))
@@ -0,0 +1,94 @@
+# staged processing of collected items - every stage runs its own workers and passes results via bounded queues
+
+from queue import Queue
+from threading import Thread
+
+from backend.helpers import log
+from backend.metrics import stage_duration
+
+# marks the end of the items in a queue - every worker of a stage receives one
+END_OF_QUEUE = object()
+
+
+class Stage:
+    """
+    one step of a pipeline, run by a number of worker threads
+    """
+
+    def __init__(self, name: str, function, workers: int = 1, queue_size: int = 100):
+        """
+        :param name: name of the stage, used for logging
+        :param function: called with every incoming item, returns an iterable of items for the next stage or None
+        :param workers: number of threads working on this stage
+        :param queue_size: maximal number of items waiting for this stage
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.queue = Queue(maxsize=max(1, queue_size))
+        self.threads = list()
+
+    def start(self, next_stage=None):
+        """
+        start worker threads which feed their results into the next stage
+        :param next_stage: stage to receive the results, None for the last stage
+        """
+        self.threads = [Thread(target=self.work, args=(next_stage,), name=f'{self.name}-{number}', daemon=True)
+                        for number in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self, next_stage=None):
+        """
+        process items until the end of the queue is reached
+        :param next_stage: stage to receive the results
+        """
+        while True:
+            item = self.queue.get()
+            if item is END_OF_QUEUE:
+                break
+            try:
+                with stage_duration.time(stage=self.name):
+                    results = self.function(item)
+                if results and next_stage:
+                    for result in results:
+                        next_stage.queue.put(result)
+            except Exception as exception:
+                # one failing item must not stop the whole pipeline
+                log.error(f'Error in collector stage {self.name}: {exception}')
+
+    def stop(self):
+        """
+        let all workers finish the queued items and wait for them
+        """
+        for _ in self.threads:
+            self.queue.put(END_OF_QUEUE)
+        for thread in self.threads:
+            thread.join()
+
+
+class Pipeline:
+    """
+    chain of stages connected by bounded queues, so memory usage stays limited and network waits overlap
+    """
+
+    def __init__(self, stages: list):
+        """
+        :param stages: list of Stage objects in order of processing
+        """
+        self.stages = stages
+
+    def run(self, items) -> None:
+        """
+        feed items into the first stage and wait until all stages are done
+        :param items: iterable of items, may be a generator which is consumed while the stages already work
+        """
+        for stage, next_stage in zip(self.stages, self.stages[1:] + [None]):
+            stage.start(next_stage)
+        try:
+            for item in items:
+                self.stages[0].queue.put(item)
+        finally:
+            # stages are stopped in order - a stage is only finished when its predecessor cannot deliver anymore
+            for stage in self.stages:
+                stage.stop()
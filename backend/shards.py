@@ -0,0 +1,116 @@
+# coordination of several collector processes - each one claims shards of the project ID space by leases in CouchDB
+
+from contextlib import contextmanager
+from os import getpid
+from random import shuffle
+from socket import gethostname
+from threading import Event, \
+    Thread
+from time import time
+from uuid import uuid4
+
+from backend.database import CouchDBDatabase
+from backend.helpers import log
+
+
+class ShardLeases:
+    """
+    leases of shards stored as documents 'shard-<number>' - a lease expires unless renewed by its owner,
+    so shards of crashed collectors are taken over by others
+    """
+
+    def __init__(self, database: CouchDBDatabase, shards: int, ttl: int, interval: int):
+        """
+        :param database: CouchDBDatabase for the lease documents
+        :param shards: number of shards the project IDs are split into
+        :param ttl: seconds until a lease expires if it is not renewed
+        :param interval: seconds between two sweeps of the same shard
+        """
+        self._database = database
+        self.shards = shards
+        self.ttl = ttl
+        self.interval = interval
+        # unique per process, readable for humans looking at the lease documents
+        self.owner = f'{gethostname()}-{getpid()}-{uuid4().hex[:8]}'
+
+    @staticmethod
+    def document_id(shard: int) -> str:
+        return f'shard-{shard}'
+
+    def claim(self, shard: int):
+        """
+        claim a shard if it is neither leased by another collector nor swept recently
+        :param shard:
+        :return: lease document as claimed or None
+        """
+        now = time()
+        lease = self._database.get_by_id(self.document_id(shard)) or dict()
+        if lease.get('owner') and lease.get('owner') != self.owner and lease.get('expires', 0) > now:
+            return None
+        if now - lease.get('swept', 0) < self.interval:
+            return None
+        claimed = {'shard': shard,
+                   'owner': self.owner,
+                   'expires': now + self.ttl,
+                   'swept': lease.get('swept', 0),
+                   'full_swept': lease.get('full_swept', 0)}
+        # if another collector was faster the revision does not match anymore and CouchDB refuses the write
+        if not self._database.store_if_unchanged(self.document_id(shard), claimed, lease.get('_rev')):
+            return None
+        return claimed
+
+    def update(self, shard: int, **values) -> bool:
+        """
+        change the lease of a shard if it is still owned by this collector
+        :param shard:
+        :param values: fields to be changed
+        :return: True if the lease was changed
+        """
+        lease = self._database.get_by_id(self.document_id(shard)) or dict()
+        if lease.get('owner') != self.owner:
+            return False
+        return self._database.store_if_unchanged(self.document_id(shard), {**lease, **values}, lease.get('_rev'))
+
+    def renew(self, shard: int, stopped: Event) -> None:
+        """
+        keep lease of a shard alive until stopped
+        :param shard:
+        :param stopped: set when the shard is done
+        """
+        # renew early enough to survive a failed attempt
+        while not stopped.wait(self.ttl / 3):
+            if not self.update(shard, expires=time() + self.ttl):
+                log.warning(f'Lost lease of shard {shard}')
+
+    def due_shards(self) -> list:
+        """
+        all shards in random order, so concurrently starting collectors do not compete for the same ones
+        :return:
+        """
+        shards = list(range(self.shards))
+        shuffle(shards)
+        return shards
+
+    @contextmanager
+    def lease(self, shard: int, full_sweep: bool):
+        """
+        hold the lease of a claimed shard while it is swept and release it afterwards
+        :param shard:
+        :param full_sweep: the sweep of the shard is a full one
+        """
+        stopped = Event()
+        renewal = Thread(target=self.renew, args=(shard, stopped), name=f'lease-{shard}', daemon=True)
+        renewal.start()
+        # a failed sweep releases the shard too, but it stays due and is swept again soon
+        values = {'owner': None, 'expires': 0}
+        try:
+            yield
+            now = time()
+            values['swept'] = now
+            if full_sweep:
+                values['full_swept'] = now
+        finally:
+            stopped.set()
+            renewal.join()
+            if not self.update(shard, **values):
+                log.warning(f'Could not release lease of shard {shard}')
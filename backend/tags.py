@@ -0,0 +1,78 @@
+# enrichment of tags collected from GitLab - kept free of database and network access
+
+from datetime import datetime
+from functools import lru_cache
+
+from datasize import DataSize
+from dateutil import parser as dateutil_parser
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """
+    parse time string from GitLab - ISO 8601 is parsed natively, anything else falls back to dateutil
+    :param timestamp:
+    :return:
+    """
+    try:
+        return datetime.fromisoformat(timestamp)
+    except ValueError:
+        return dateutil_parser.parse(timestamp)
+
+
+@lru_cache(maxsize=4096)
+def format_size(size: int) -> str:
+    """
+    human-readable size - tags sharing a revision share their size, so the formatting is cached
+    :param size: size in bytes
+    :return:
+    """
+    return '{:.2a}'.format(DataSize(size))
+
+
+class TagsSummary:
+    """
+    what a container image needs to know about all of its tags
+    """
+    __slots__ = ('last_update', 'last_update_tag', 'size', 'revisions')
+
+    def __init__(self):
+        # empty default values may better be '' than None to avoid concat crashes
+        self.last_update = ''
+        self.last_update_tag = ''
+        # the whole sum of all images tags
+        self.size = 0
+        # revision -> list of tags sharing it
+        self.revisions = dict()
+
+
+def enrich_tags(tags: dict) -> TagsSummary:
+    """
+    add human-readable values and revision colors to tags and summarize them, all in a single pass
+    :param tags: tags of a container image by name, changed in place
+    :return: summary of the tags
+    """
+    summary = TagsSummary()
+    for tag in tags.values():
+        # parse time string from Gitlab into datetime object - only once per tag
+        if tag.get('created_at'):
+            tag_created_at = parse_timestamp(tag['created_at'])
+            # when currently checked tag is newer than latest known it become the new last_update
+            if not summary.last_update or summary.last_update < tag_created_at:
+                summary.last_update = tag_created_at
+                summary.last_update_tag = tag['name']
+            # add human-readable tag image size
+            tag['total_size_human_readable'] = format_size(tag['total_size'])
+            # add human-readable tag creation date
+            tag['created_at_human_readable'] = tag_created_at.strftime('%Y-%m-%d %H:%M:%S')
+            # add size of this tag to total size of container image
+            summary.size += tag['total_size']
+        # default is no background color
+        tag['tag_revision_background_color'] = ''
+        if tag.get('revision'):
+            summary.revisions.setdefault(tag['revision'], list()).append(tag)
+    # change only background color for those which have more than 1 which have the same revision
+    for revision, revision_tags in summary.revisions.items():
+        if len(revision_tags) > 1:
+            for tag in revision_tags:
+                tag['tag_revision_background_color'] = revision[0:6]
+    return summary
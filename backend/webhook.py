@@ -0,0 +1,174 @@
+# receiver of GitLab webhooks and registry notifications - triggers refreshes of single projects between sweeps
+
+from http.server import BaseHTTPRequestHandler, \
+    ThreadingHTTPServer
+from json import loads
+from secrets import compare_digest
+from threading import Condition, \
+    Thread
+from time import monotonic
+
+from backend.helpers import log
+
+
+class RefreshQueue:
+    """
+    collects projects to be refreshed - bursts of events for the same project are coalesced into one refresh
+    """
+
+    def __init__(self, refresh, debounce: float = 5, max_delay: float = 60):
+        """
+        :param refresh: called with a list of project references, each a project ID or a repository path
+        :param debounce: seconds without further events for a project before it gets refreshed
+        :param max_delay: seconds after the first event after which a project is refreshed even if events keep coming
+        """
+        self._refresh = refresh
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # project reference -> (time of first event, time of last event)
+        self._pending = dict()
+        self._condition = Condition()
+        self._thread = None
+
+    def add(self, reference) -> None:
+        """
+        request refresh of a project
+        :param reference: project ID or repository path
+        """
+        now = monotonic()
+        with self._condition:
+            first, _ = self._pending.get(reference, (now, now))
+            self._pending[reference] = (first, now)
+            self._condition.notify()
+
+    def due(self, now: float) -> tuple:
+        """
+        references whose refresh is due - lock has to be held
+        :param now:
+        :return: list of due references and seconds until the next one is due
+        """
+        due = list()
+        wait = None
+        for reference, (first, last) in self._pending.items():
+            due_at = min(last + self.debounce, first + self.max_delay)
+            if due_at <= now:
+                due.append(reference)
+            else:
+                wait = min(wait, due_at - now) if wait is not None else due_at - now
+        for reference in due:
+            del self._pending[reference]
+        return due, wait
+
+    def start(self) -> None:
+        """
+        start refreshing in a daemon thread - only once
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._work, name='refresh', daemon=True)
+            self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                due, wait = self.due(monotonic())
+                while not due:
+                    self._condition.wait(wait)
+                    due, wait = self.due(monotonic())
+            try:
+                self._refresh(due)
+            except Exception as exception:
+                log.error(f'Error refreshing projects {due}: {exception}')
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def references_of_event(event: dict) -> list:
+    """
+    get projects concerned by an event
+    GitLab webhooks like push, tag push or pipeline events carry the project, registry notifications only the
+    path of the repository which starts with the path of its project
+    :param event: JSON body of the request
+    :return: list of project IDs and repository paths
+    """
+    references = list()
+    if isinstance(event.get('project_id'), int):
+        references.append(event['project_id'])
+    elif isinstance(event.get('project'), dict) and isinstance(event['project'].get('id'), int):
+        references.append(event['project']['id'])
+    for registry_event in event.get('events') or list():
+        repository = (registry_event.get('target') or dict()).get('repository')
+        if registry_event.get('action') in ('push', 'delete') and repository:
+            references.append(repository)
+    return references
+
+
+class WebhookServer:
+    """
+    HTTP server accepting webhook POST requests in a daemon thread
+    """
+
+    def __init__(self, queue: RefreshQueue, address: str = '0.0.0.0', port: int = 8001, token: str = ''):
+        """
+        :param queue: queue to put requested refreshes into
+        :param address: address to listen at
+        :param port: port to listen at
+        :param token: secret expected in header X-Gitlab-Token or as bearer token, empty accepts every request
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server.handle(self)
+
+        self.queue = queue
+        self.token = token
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+
+    def authorized(self, headers) -> bool:
+        """
+        check secret token - GitLab sends it as X-Gitlab-Token, the container registry as Authorization header
+        :param headers:
+        :return:
+        """
+        if not self.token:
+            return True
+        token = headers.get('X-Gitlab-Token') or headers.get('Authorization', '').removeprefix('Bearer ')
+        return compare_digest(token.encode(), self.token.encode())
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        """
+        accept event and answer immediately - the refresh happens later
+        :param handler:
+        """
+        if not self.authorized(handler.headers):
+            status = 401
+        else:
+            try:
+                length = int(handler.headers.get('Content-Length') or 0)
+                event = loads(handler.rfile.read(length) or b'{}')
+                references = references_of_event(event) if isinstance(event, dict) else list()
+                for reference in references:
+                    self.queue.add(reference)
+                log.info(f'Webhook requested refresh of {references}')
+                status = 202
+            except ValueError as exception:
+                log.error(f'Invalid webhook request: {exception}')
+                status = 400
+        handler.send_response(status)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+
+    def start(self) -> None:
+        """
+        serve in a daemon thread
+        """
+        Thread(target=self._server.serve_forever, name='webhook', daemon=True).start()
+        log.info(f'Listening for webhooks at port {self._server.server_address[1]}')
+
+    def stop(self) -> None:
+        self._server.shutdown()
@@ -0,0 +1,150 @@
+# benchmark of the collector against a local fake GitLab and fake CouchDB
+# run from repository root, e.g.: python -m benchmark.collector --projects 1000 --repositories 5 --tags 50
+# fakes run in their own process, so the measured peak RSS is the one of the collector
+
+from argparse import ArgumentParser
+from json import dumps
+from multiprocessing import Pipe, \
+    Process
+from pathlib import Path
+from resource import getrusage, \
+    RUSAGE_SELF
+from sys import argv
+from tempfile import mkdtemp
+from time import perf_counter
+
+from httpx import get
+from yaml import safe_dump, \
+    safe_load
+
+from benchmark.fake_couchdb import FakeCouchDB
+from benchmark.fake_gitlab import Dataset, \
+    FakeGitLab
+
+
+def serve_fakes(connection, dataset: Dataset, latency: float, jitter: float, error_rate: float) -> None:
+    """
+    run fake GitLab and fake CouchDB until the benchmark ends
+    :param connection: pipe to send URLs of the fakes to
+    :param dataset:
+    :param latency:
+    :param jitter:
+    :param error_rate:
+    """
+    gitlab = FakeGitLab(dataset, latency=latency, jitter=jitter, error_rate=error_rate).start()
+    couchdb = FakeCouchDB().start()
+    connection.send((gitlab.url, couchdb.url))
+    # wait until the benchmark closes the pipe
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+
+
+def parse_arguments(arguments: list):
+    """
+    :param arguments: command line arguments
+    :return: parsed arguments
+    """
+    parser = ArgumentParser(description='benchmark of the collector')
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--repositories', type=int, default=5, help='container images per project')
+    parser.add_argument('--tags', type=int, default=20, help='tags per container image')
+    parser.add_argument('--registry-ratio', type=float, default=1, help='fraction of projects having container images')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every GitLab response')
+    parser.add_argument('--jitter', type=float, default=0, help='maximal seconds randomly added to latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of GitLab requests failing with 503')
+    parser.add_argument('--sweeps', type=int, default=1, help='number of sweeps - later ones profit from caches')
+    parser.add_argument('--set', action='append', default=list(), metavar='KEY=VALUE',
+                        help='collector setting like workers.tags=4 or tag_concurrency=8')
+    parser.add_argument('--json', action='store_true', help='print results as JSON to compare versions')
+    return parser.parse_args(arguments)
+
+
+def collector_settings(settings: list) -> dict:
+    """
+    nested collector settings from KEY=VALUE pairs, values are parsed as YAML
+    :param settings:
+    :return:
+    """
+    collector = dict()
+    for setting in settings:
+        key, value = setting.split('=', 1)
+        target = collector
+        parts = key.split('.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, dict())
+        target[parts[-1]] = safe_load(value)
+    return collector
+
+
+def main(arguments) -> dict:
+    """
+    run sweeps against the fakes and measure them
+    :param arguments: parsed command line arguments
+    :return: results
+    """
+    dataset = Dataset(arguments.projects, arguments.repositories, arguments.tags,
+                      registry_ratio=arguments.registry_ratio)
+    connection, fakes_connection = Pipe()
+    fakes = Process(target=serve_fakes,
+                    args=(fakes_connection, dataset, arguments.latency, arguments.jitter, arguments.error_rate),
+                    daemon=True)
+    fakes.start()
+    gitlab_url, couchdb_url = connection.recv()
+
+    config_file = Path(mkdtemp()) / 'config.yaml'
+    config_file.write_text(safe_dump({'api': {'url': gitlab_url, 'token': 'benchmark'},
+                                      'registry': dataset.registry,
+                                      'couchdb': {'url': couchdb_url, 'user': 'admin', 'password': 'admin'},
+                                      'collector': collector_settings(arguments.set)}))
+    # the collector reads its config from the command line when imported
+    argv[1:] = ['--config-file', str(config_file), '--mode', 'collect']
+    from backend.collect import sweep_projects
+    from backend.helpers import log
+    log.setLevel('WARNING')
+
+    container_images = sum(dataset.has_repositories(x) for x in range(1, dataset.projects + 1)) * dataset.repositories
+    results = {'projects': dataset.projects,
+               'container_images': container_images,
+               'tags': container_images * dataset.tags,
+               'sweeps': list()}
+    for _ in range(arguments.sweeps):
+        gitlab_before = get(f'{gitlab_url}/_stats').json()
+        couchdb_before = get(f'{couchdb_url}/_fake_stats').json()
+        start = perf_counter()
+        # one cycle of run_collector, which itself loops forever
+        sweep_projects(full_sweep=True)
+        seconds = perf_counter() - start
+        gitlab_after = get(f'{gitlab_url}/_stats').json()
+        couchdb_after = get(f'{couchdb_url}/_fake_stats').json()
+        gitlab_requests = gitlab_after['requests'] - gitlab_before['requests']
+        results['sweeps'].append({'seconds': round(seconds, 3),
+                                  'gitlab_requests': gitlab_requests,
+                                  'gitlab_requests_per_second': round(gitlab_requests / seconds, 1),
+                                  'gitlab_errors': gitlab_after['errors'] - gitlab_before['errors'],
+                                  'gitlab_not_modified': gitlab_after['not_modified'] - gitlab_before['not_modified'],
+                                  'couchdb_requests': couchdb_after['requests'] - couchdb_before['requests'],
+                                  'container_images_stored': couchdb_after['documents'].get('container_images', 0)})
+    # kilobytes on Linux
+    results['peak_rss_mb'] = round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1)
+    connection.close()
+    fakes.join(timeout=5)
+    return results
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments(argv[1:])
+    results = main(arguments)
+    if arguments.json:
+        print(dumps(results))
+    else:
+        print(f"{results['projects']} projects, {results['container_images']} container images, "
+              f"{results['tags']} tags")
+        for number, sweep in enumerate(results['sweeps'], start=1):
+            print(f"sweep {number}: {sweep['seconds']:.2f} s, "
+                  f"{sweep['gitlab_requests']} GitLab requests ({sweep['gitlab_requests_per_second']}/s, "
+                  f"{sweep['gitlab_errors']} errors, {sweep['gitlab_not_modified']} not modified), "
+                  f"{sweep['couchdb_requests']} CouchDB requests, "
+                  f"{sweep['container_images_stored']} container images stored")
+        print(f"peak RSS: {results['peak_rss_mb']} MB")
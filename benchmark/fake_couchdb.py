@@ -0,0 +1,323 @@
+# in-memory stand-in for the parts of the CouchDB API used by couchdb3 and this application
+
+from json import dumps, \
+    loads
+from re import search
+from threading import Condition, \
+    Thread
+from http.server import BaseHTTPRequestHandler, \
+    ThreadingHTTPServer
+from urllib.parse import parse_qs, \
+    unquote, \
+    urlsplit
+from uuid import uuid4
+
+
+def get_field(document: dict, field: str):
+    """
+    get value of a dotted field like 'project.id'
+    """
+    value = document
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def matches(document: dict, selector: dict) -> bool:
+    """
+    evaluate the subset of Mango selectors used by the application
+    """
+    for key, condition in selector.items():
+        if key == '$and':
+            if not all(matches(document, x) for x in condition):
+                return False
+            continue
+        if key == '$or':
+            if not any(matches(document, x) for x in condition):
+                return False
+            continue
+        value = get_field(document, key)
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for operator, argument in condition.items():
+            if operator == '$eq' and value != argument:
+                return False
+            if operator == '$ne' and value == argument:
+                return False
+            if operator == '$in' and value not in argument:
+                return False
+            if operator == '$nin' and value in argument:
+                return False
+            if operator == '$exists' and (value is not None) != argument:
+                return False
+            if operator == '$regex' and (not isinstance(value, str) or not search(argument, value)):
+                return False
+            if operator == '$mod' and (not isinstance(value, int) or value % argument[0] != argument[1]):
+                return False
+            if operator in ('$gt', '$gte', '$lt', '$lte'):
+                if value is None:
+                    return False
+                if argument is None:
+                    # null sorts before everything else in CouchDB
+                    if operator in ('$lt', '$lte'):
+                        return False
+                    continue
+                if operator == '$gt' and not value > argument:
+                    return False
+                if operator == '$gte' and not value >= argument:
+                    return False
+                if operator == '$lt' and not value < argument:
+                    return False
+                if operator == '$lte' and not value <= argument:
+                    return False
+    return True
+
+
+def project(document: dict, fields: list) -> dict:
+    """
+    apply 'fields' projection
+    """
+    if not fields:
+        return document
+    result = dict()
+    for field in fields:
+        value = get_field(document, field)
+        if value is None:
+            continue
+        target = result
+        parts = field.split('.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, dict())
+        target[parts[-1]] = value
+    return result
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.documents = dict()
+        # document ID -> sequence number of its last change
+        self.changes = dict()
+        self.deleted = dict()
+        self.sequence = 0
+
+    def write(self, document: dict) -> dict:
+        document_id = document.get('_id') or uuid4().hex
+        current = self.documents.get(document_id)
+        if current and current['_rev'] != document.get('_rev'):
+            return {'id': document_id, 'error': 'conflict', 'reason': 'Document update conflict.'}
+        if not current and document.get('_rev') and document_id not in self.deleted:
+            return {'id': document_id, 'error': 'conflict', 'reason': 'Document update conflict.'}
+        generation = int((current or self.deleted.get(document_id) or {'_rev': '0-x'})['_rev'].split('-')[0]) + 1
+        revision = f'{generation}-{uuid4().hex}'
+        self.sequence += 1
+        self.changes[document_id] = self.sequence
+        if document.get('_deleted'):
+            self.documents.pop(document_id, None)
+            self.deleted[document_id] = {'_id': document_id, '_rev': revision}
+        else:
+            self.deleted.pop(document_id, None)
+            self.documents[document_id] = {**document, '_id': document_id, '_rev': revision}
+        return {'id': document_id, 'ok': True, 'rev': revision}
+
+
+class FakeCouchDB:
+    """
+    CouchDB stand-in served by a threaded HTTP server
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.databases = dict()
+        self.condition = Condition()
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately - without this every response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, 'GET')
+
+            def do_HEAD(self):
+                fake.handle(self, 'HEAD')
+
+            def do_PUT(self):
+                fake.handle(self, 'PUT')
+
+            def do_POST(self):
+                fake.handle(self, 'POST')
+
+            def do_DELETE(self):
+                fake.handle(self, 'DELETE')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    @staticmethod
+    def reply(handler, status: int, body=None, headers: dict = None):
+        payload = dumps(body).encode() if body is not None else b''
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or dict()).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(payload)
+
+    def handle(self, handler, method: str):
+        self.requests += 1
+        url = urlsplit(handler.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = loads(handler.rfile.read(length)) if length else None
+        # keep encoded slashes inside document IDs
+        parts = [unquote(x) for x in url.path.strip('/').split('/') if x]
+        try:
+            status, result, headers = self.route(method, parts, query, body)
+        except KeyError:
+            status, result, headers = 404, {'error': 'not_found', 'reason': 'missing'}, None
+        self.reply(handler, status, result, headers)
+
+    def route(self, method: str, parts: list, query: dict, body):
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': '3.3.3'}, None
+        if parts == ['_session']:
+            return 200, {'ok': True}, {'Set-Cookie': 'AuthSession=fake; Path=/; Expires=Fri, 01 Jan 2100 00:00:00 GMT'}
+        if parts == ['_all_dbs']:
+            return 200, sorted(self.databases), None
+        if parts == ['_fake_stats']:
+            return 200, {'requests': self.requests,
+                         'documents': {name: sum(not y.startswith('_design/') for y in x.documents)
+                                       for name, x in self.databases.items()}}, None
+        name = parts[0]
+        if len(parts) == 1:
+            if method == 'PUT':
+                self.databases.setdefault(name, FakeDatabase())
+                return 201, {'ok': True}, None
+            database = self.databases[name]
+            return 200, {'db_name': name,
+                         'doc_count': len(database.documents),
+                         'update_seq': f'{database.sequence}-fake'}, None
+        database = self.databases[name]
+        resource = parts[1]
+        with self.condition:
+            if resource == '_index':
+                return 200, {'result': 'created', 'id': f"_design/{body.get('ddoc')}",
+                             'name': body.get('name') or body.get('ddoc')}, None
+            if resource == '_find':
+                return 200, self.find(database, body), None
+            if resource == '_all_docs':
+                return 200, self.all_docs(database, query, body), None
+            if resource == '_design' and len(parts) == 5 and parts[3] == '_view':
+                return 200, self.view(database, parts[2], parts[4], query, body), None
+            if resource == '_bulk_docs':
+                results = [database.write(document) for document in body['docs']]
+                self.condition.notify_all()
+                return 201, results, None
+        if resource == '_changes':
+            return 200, self.changes_feed(database, query), None
+        document_id = '/'.join(parts[1:])
+        with self.condition:
+            if method in ('GET', 'HEAD'):
+                return 200, database.documents[document_id], None
+            if method == 'PUT':
+                body['_id'] = document_id
+                if query.get('rev'):
+                    body['_rev'] = query['rev']
+                result = database.write(body)
+                self.condition.notify_all()
+                return (409, result, None) if result.get('error') else (201, result, None)
+            if method == 'DELETE':
+                result = database.write({'_id': document_id, '_rev': query.get('rev'), '_deleted': True})
+                self.condition.notify_all()
+                return (409, result, None) if result.get('error') else (200, result, None)
+        return 405, {'error': 'method_not_allowed'}, None
+
+    @staticmethod
+    def find(database: FakeDatabase, body: dict) -> dict:
+        selector = body.get('selector', dict())
+        # like CouchDB, every Mango query scans - '$in' on _id too, only _all_docs with keys reads single documents
+        documents = [x for x in database.documents.values() if matches(x, selector)]
+        for sort in reversed(body.get('sort') or list()):
+            field, order = (sort, 'asc') if isinstance(sort, str) else next(iter(sort.items()))
+            documents.sort(key=lambda x: (get_field(x, field) is not None, get_field(x, field)),
+                           reverse=order == 'desc')
+        skip = body.get('skip', 0)
+        if body.get('bookmark') and body['bookmark'] != 'nil':
+            skip = int(body['bookmark'])
+        limit = body.get('limit', 25)
+        page = documents[skip:skip + limit]
+        return {'docs': [project(x, body.get('fields')) for x in page],
+                'bookmark': str(skip + len(page))}
+
+    @staticmethod
+    def all_docs(database: FakeDatabase, query: dict, body) -> dict:
+        include_docs = query.get('include_docs') == 'true'
+        keys = (body or dict()).get('keys') or (loads(query['keys']) if query.get('keys') else None)
+        rows = list()
+        for key in keys if keys is not None else sorted(database.documents):
+            document = database.documents.get(key)
+            if document:
+                row = {'id': key, 'key': key, 'value': {'rev': document['_rev']}}
+                if include_docs:
+                    row['doc'] = document
+            elif key in database.deleted:
+                row = {'id': key, 'key': key, 'value': {'rev': database.deleted[key]['_rev'], 'deleted': True}}
+                if include_docs:
+                    row['doc'] = None
+            else:
+                row = {'key': key, 'error': 'not_found'}
+            rows.append(row)
+        return {'total_rows': len(database.documents), 'offset': 0, 'rows': rows}
+
+    @staticmethod
+    def view(database: FakeDatabase, design: str, name: str, query: dict, body) -> dict:
+        """
+        only views emitting a field by document ID like 'emit(doc._id, doc.fingerprint)' are understood
+        """
+        source = database.documents[f'_design/{design}']['views'][name]['map']
+        field = search(r'emit\(doc\._id, doc\.(\w+)\)', source).group(1)
+        keys = (body or dict()).get('keys') or (loads(query['keys']) if query.get('keys') else None)
+        rows = [{'id': key, 'key': key, 'value': database.documents[key][field]}
+                for key in (keys if keys is not None else sorted(database.documents))
+                if field in database.documents.get(key, dict())]
+        return {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+
+    def changes_feed(self, database: FakeDatabase, query: dict) -> dict:
+        since = query.get('since', '0')
+        since = database.sequence if since == 'now' else int(str(since).split('-')[0])
+        with self.condition:
+            if query.get('feed') == 'longpoll' and database.sequence <= since:
+                self.condition.wait(timeout=int(query.get('timeout', 60000)) / 1000)
+            results = list()
+            for document_id, sequence in sorted(database.changes.items(), key=lambda x: x[1]):
+                if sequence <= since:
+                    continue
+                change = {'id': document_id, 'seq': f'{sequence}-fake'}
+                if document_id in database.deleted:
+                    change['deleted'] = True
+                    change['changes'] = [{'rev': database.deleted[document_id]['_rev']}]
+                else:
+                    change['changes'] = [{'rev': database.documents[document_id]['_rev']}]
+                    if query.get('include_docs') == 'true':
+                        change['doc'] = database.documents[document_id]
+                results.append(change)
+                if query.get('limit') and len(results) >= int(query['limit']):
+                    break
+            last_seq = results[-1]['seq'] if results else f'{since}-fake'
+            return {'results': results, 'last_seq': last_seq, 'pending': 0}
@@ -0,0 +1,276 @@
+# stand-in for the parts of the GitLab API used by the collector, serving a synthetic dataset of configurable size
+
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, \
+    ThreadingHTTPServer
+from json import dumps
+from random import random, \
+    uniform
+from re import fullmatch
+from threading import Lock, \
+    Thread
+from time import sleep
+from urllib.parse import parse_qs, \
+    unquote, \
+    urlencode, \
+    urlsplit
+
+README = '''# Project {project_id}
+
+Synthetic project of the benchmark.
+
+| image | tags |
+|-------|------|
+| image0 | many |
+
+```
+docker pull registry.bench/project{project_id}/image0:latest
+```
+'''
+
+
+class Dataset:
+    """
+    synthetic projects, container images and tags, computed on demand so even huge datasets need no memory
+    """
+
+    def __init__(self, projects: int = 100, repositories: int = 5, tags: int = 20, registry: str = 'registry.bench',
+                 registry_ratio: float = 1):
+        """
+        :param projects: number of projects
+        :param repositories: number of container images per project
+        :param tags: number of tags per container image
+        :param registry: host name of the container registry
+        :param registry_ratio: fraction of projects having container images
+        """
+        self.projects = projects
+        self.repositories = repositories
+        self.tags = tags
+        self.registry = registry
+        self.registry_ratio = registry_ratio
+
+    def has_repositories(self, project_id: int) -> bool:
+        # spread evenly over all groups
+        return project_id % 100 < self.registry_ratio * 100
+
+    def group_project_ids(self, group: str) -> list:
+        """
+        IDs of projects in a group like 'group3' - every group contains up to 100 projects
+        :param group: path of group
+        :return:
+        """
+        match = fullmatch(r'group(\d+)', group)
+        if not match:
+            return list()
+        start = int(match.group(1)) * 100
+        return list(range(max(1, start), min(start + 99, self.projects) + 1))
+
+    def project(self, project_id: int) -> dict:
+        group = f'group{project_id // 100}'
+        return {'id': project_id,
+                'name': f'project{project_id}',
+                'path_with_namespace': f'{group}/project{project_id}',
+                'description': f'Synthetic project {project_id}',
+                'web_url': f'https://gitlab.bench/{group}/project{project_id}',
+                'readme_url': f'https://gitlab.bench/{group}/project{project_id}/-/blob/main/README.md',
+                'last_activity_at': '2024-01-01T00:00:00.000Z',
+                'container_registry_enabled': True,
+                'container_expiration_policy': {'enabled': project_id % 2 == 0}}
+
+    def repository(self, project_id: int, number: int) -> dict:
+        project = self.project(project_id)
+        path = f"{project['path_with_namespace']}/image{number}"
+        return {'id': project_id * 1000 + number,
+                'name': f'image{number}',
+                'path': path,
+                'project_id': project_id,
+                'location': f'{self.registry}/{path}',
+                'created_at': '2024-01-01T00:00:00.000Z',
+                'tags_count': self.tags,
+                'tags': [{'name': f'1.{x}', 'path': f'{path}:1.{x}', 'location': f'{self.registry}/{path}:1.{x}'}
+                         for x in range(self.tags)]}
+
+    def tag(self, repository_id: int, name: str) -> dict:
+        number = int(name.split('.')[-1])
+        # every 2 tags share a revision
+        revision = sha1(f'{repository_id}-{number // 2}'.encode()).hexdigest() * 2
+        return {'name': name,
+                'path': f'image:{name}',
+                'location': f'{self.registry}/image:{name}',
+                'revision': revision[:64],
+                'short_revision': revision[:9],
+                'digest': f'sha256:{revision[:64]}',
+                'created_at': f'2024-01-{1 + number % 28:02d}T{number % 24:02d}:00:00.000+00:00',
+                'total_size': 10000000 + repository_id % 1000 * 1000 + number}
+
+
+class FakeGitLab:
+    """
+    GitLab API stand-in served by a threaded HTTP server, with optional latency and errors
+    """
+
+    def __init__(self, dataset: Dataset, latency: float = 0, jitter: float = 0, error_rate: float = 0,
+                 host: str = '127.0.0.1', port: int = 0):
+        """
+        :param dataset: data to be served
+        :param latency: seconds added to every response
+        :param jitter: maximal seconds randomly added to latency
+        :param error_rate: fraction of requests answered with 503
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self._lock = Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately - without this every response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def do_HEAD(self):
+                fake.handle(self)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, **values) -> None:
+        with self._lock:
+            for key, value in values.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    @staticmethod
+    def reply(handler, status: int, body: bytes = b'', headers: dict = None):
+        handler.send_response(status)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or dict()).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def handle(self, handler):
+        url = urlsplit(handler.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/_stats':
+            body = dumps({'requests': self.requests, 'errors': self.errors, 'not_modified': self.not_modified})
+            self.reply(handler, 200, body.encode(), {'Content-Type': 'application/json'})
+            return
+        self.count(requests=1)
+        if self.latency or self.jitter:
+            sleep(self.latency + uniform(0, self.jitter))
+        if self.error_rate and random() < self.error_rate:
+            self.count(errors=1)
+            self.reply(handler, 503, b'{"message":"503 Service Unavailable"}')
+            return
+        status, body, headers = self.route(url.path.removeprefix('/api/v4'), query)
+        if status == 200:
+            # conditional requests of the collector are answered like GitLab does
+            etag = f'W/"{sha1(body).hexdigest()}"'
+            headers['ETag'] = etag
+            if handler.headers.get('If-None-Match') == etag:
+                self.count(not_modified=1)
+                self.reply(handler, 304, b'', {'ETag': etag})
+                return
+        self.reply(handler, status, body, headers)
+
+    def route(self, path: str, query: dict) -> tuple:
+        """
+        answer a request
+        :param path: path without API prefix
+        :param query: query parameters
+        :return: status, body and headers
+        """
+        dataset = self.dataset
+        json = {'Content-Type': 'application/json'}
+        per_page = min(100, int(query.get('per_page', 20)))
+        page = int(query.get('page', 1))
+        if path == '/projects' and query.get('pagination') == 'keyset':
+            # like GitLab, keyset pagination has no totals, only a link to the next page
+            id_after = int(query.get('id_after', 0))
+            last = min(id_after + per_page, dataset.projects)
+            projects = [dataset.project(x) for x in range(id_after + 1, last + 1)]
+            headers = dict(json)
+            if last < dataset.projects:
+                next_query = urlencode({**query, 'id_after': last})
+                headers['Link'] = f'<{self.url}/api/v4/projects?{next_query}>; rel="next"'
+            return 200, dumps(projects).encode(), headers
+        if path == '/projects':
+            total_pages = max(1, -(-dataset.projects // per_page))
+            start = (page - 1) * per_page
+            projects = [dataset.project(x) for x in range(start + 1, min(start + per_page, dataset.projects) + 1)]
+            headers = {**json,
+                       'x-page': str(page),
+                       'x-per-page': str(per_page),
+                       'x-total': str(dataset.projects),
+                       'x-total-pages': str(total_pages),
+                       'x-next-page': str(page + 1) if page < total_pages else ''}
+            return 200, dumps(projects).encode(), headers
+        match = fullmatch(r'/groups/([^/]+)/registry/repositories', path)
+        if match:
+            project_ids = dataset.group_project_ids(unquote(match.group(1)))
+            if not project_ids:
+                return 404, b'{"message":"404 Group Not Found"}', json
+            # like GitLab, repositories of the group are listed without their tags
+            repositories = [{key: value for key, value in dataset.repository(x, y).items()
+                             if key not in ('tags', 'tags_count')}
+                            for x in project_ids if dataset.has_repositories(x)
+                            for y in range(dataset.repositories)]
+            total_pages = max(1, -(-len(repositories) // per_page))
+            start = (page - 1) * per_page
+            headers = {**json,
+                       'x-page': str(page),
+                       'x-per-page': str(per_page),
+                       'x-total': str(len(repositories)),
+                       'x-total-pages': str(total_pages),
+                       'x-next-page': str(page + 1) if page < total_pages else ''}
+            return 200, dumps(repositories[start:start + per_page]).encode(), headers
+        match = fullmatch(r'/projects/([^/]+)(/.*)?', path)
+        if not match:
+            return 404, b'{"message":"404 Not Found"}', json
+        reference, rest = unquote(match.group(1)), match.group(2) or ''
+        if reference.isdigit():
+            project_id = int(reference)
+        elif fullmatch(r'group\d+/project\d+', reference):
+            project_id = int(reference.split('project')[-1])
+        else:
+            project_id = 0
+        if not 0 < project_id <= dataset.projects:
+            return 404, b'{"message":"404 Project Not Found"}', json
+        if rest == '':
+            return 200, dumps(dataset.project(project_id)).encode(), json
+        if rest == '/registry/repositories':
+            repositories = [dataset.repository(project_id, x) for x in range(dataset.repositories)
+                            if dataset.has_repositories(project_id)]
+            return 200, dumps(repositories).encode(), json
+        match = fullmatch(r'/registry/repositories/(\d+)/tags/([^/]+)', rest)
+        if match:
+            return 200, dumps(dataset.tag(int(match.group(1)), unquote(match.group(2)))).encode(), json
+        match = fullmatch(r'/repository/files/([^/]+)(/raw)?', rest)
+        if match:
+            readme = README.format(project_id=project_id).encode()
+            headers = {'X-Gitlab-Blob-Id': sha1(readme).hexdigest(),
+                       'X-Gitlab-File-Name': unquote(match.group(1)),
+                       'X-Gitlab-Size': str(len(readme))}
+            if match.group(2):
+                return 200, readme, {**headers, 'Content-Type': 'text/plain'}
+            return 200, b'', headers
+        return 404, b'{"message":"404 Not Found"}', json
@@ -0,0 +1,105 @@
+# micro-benchmark of tag enrichment - compares the former per-tag path with backend.tags.enrich_tags
+# run from repository root: python -m benchmark.tags_enrich [number of tags]
+
+from copy import deepcopy
+from datetime import datetime, \
+    timedelta, \
+    timezone
+from sys import argv
+from time import perf_counter
+
+from datasize import DataSize
+from dateutil import parser as dateutil_parser
+
+from backend.tags import enrich_tags
+
+
+def create_tags(count: int) -> dict:
+    """
+    tags like delivered by GitLab, every 3 of them sharing a revision
+    :param count:
+    :return:
+    """
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    tags = dict()
+    for number in range(count):
+        name = f'1.{number}'
+        tags[name] = {'name': name,
+                      'created_at': (start + timedelta(minutes=number)).isoformat(timespec='milliseconds'),
+                      'total_size': 1000000 + number // 3,
+                      'revision': f'{number // 3:064x}',
+                      'short_revision': f'{number // 3:010x}'}
+    return tags
+
+
+def enrich_tags_former(tags: dict) -> dict:
+    """
+    former implementation - parses each timestamp twice and compares revisions for every pair of revision and tag
+    :param tags:
+    :return:
+    """
+    summary = {'last_update': '', 'last_update_tag': '', 'size': 0}
+    for tag in tags.values():
+        if tag.get('created_at'):
+            tag_created_at = dateutil_parser.parse(tag.get('created_at'))
+            if summary['last_update']:
+                if summary['last_update'] < tag_created_at:
+                    summary['last_update'] = tag_created_at
+                    summary['last_update_tag'] = tag['name']
+            else:
+                summary['last_update'] = tag_created_at
+                summary['last_update_tag'] = tag['name']
+            tag['total_size_human_readable'] = '{:.2a}'.format(DataSize(tag['total_size']))
+            tag['created_at_human_readable'] = dateutil_parser.parse(tag['created_at']).strftime(
+                '%Y-%m-%d %H:%M:%S')
+            summary['size'] += tag['total_size']
+    revisions = dict()
+    for tag, properties in tags.items():
+        revision = properties.get('revision')
+        properties['tag_revision_background_color'] = ''
+        if revision:
+            revisions.setdefault(revision, list())
+            revisions[revision].append(tag)
+    for revision in [x for x in revisions.keys() if len(revisions[x]) > 1]:
+        for tag, properties in tags.items():
+            if tag in revisions[revision]:
+                properties['tag_revision_background_color'] = revision[0:6]
+    return summary
+
+
+def measure(function, tags: dict, number: int = 3) -> float:
+    """
+    best time of several runs, each on a fresh copy of the tags
+    :param function:
+    :param tags:
+    :param number:
+    :return: seconds
+    """
+    seconds = list()
+    for _ in range(number):
+        tags_copy = deepcopy(tags)
+        start = perf_counter()
+        function(tags_copy)
+        seconds.append(perf_counter() - start)
+    return min(seconds)
+
+
+if __name__ == '__main__':
+    count = int(argv[1]) if len(argv) > 1 else 5000
+    tags = create_tags(count)
+
+    # both have to deliver the same results
+    tags_former = deepcopy(tags)
+    tags_current = deepcopy(tags)
+    summary_former = enrich_tags_former(tags_former)
+    summary_current = enrich_tags(tags_current)
+    assert tags_former == tags_current
+    assert (summary_former['last_update'], summary_former['last_update_tag'], summary_former['size']) == \
+           (summary_current.last_update, summary_current.last_update_tag, summary_current.size)
+
+    seconds_former = measure(enrich_tags_former, tags)
+    seconds_current = measure(enrich_tags, tags)
+    print(f'{count} tags')
+    print(f'former:  {seconds_former * 1000:10.1f} ms')
+    print(f'current: {seconds_current * 1000:10.1f} ms')
+    print(f'speedup: {seconds_former / seconds_current:10.1f}x')
@@ -0,0 +1,239 @@
+# latency benchmark of the web frontend against a synthetic dataset in a fake CouchDB
+# run from repository root, e.g.: python -m benchmark.web --images 50000 --requests 200
+# requests are sent through the Flask test client, so only the application itself is measured
+
+from argparse import ArgumentParser
+from datetime import datetime, \
+    timedelta, \
+    timezone
+from hashlib import sha256
+from json import dumps
+from multiprocessing import Pipe, \
+    Process
+from pathlib import Path
+from sys import argv
+from tempfile import mkdtemp
+from time import perf_counter
+
+from yaml import safe_dump
+
+from backend.helpers import sort_tags
+from backend.tags import enrich_tags, \
+    format_size
+from benchmark.fake_couchdb import FakeCouchDB, \
+    FakeDatabase
+
+REGISTRY = 'registry.bench'
+# page numbers of search results to be measured
+PAGE_DEPTHS = (1, 10, 100, 1000)
+
+
+def create_tags(count: int) -> dict:
+    """
+    tags as stored by the collector
+    :param count:
+    :return:
+    """
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    tags = {f'1.{x}': {'name': f'1.{x}',
+                       'created_at': (start + timedelta(minutes=x)).isoformat(timespec='milliseconds'),
+                       'total_size': 10000000 + x,
+                       'revision': f'{x // 2:064x}',
+                       'short_revision': f'{x // 2:09x}'}
+            for x in range(count)}
+    enrich_tags(tags)
+    return tags
+
+
+def populate(couchdb: FakeCouchDB, images: int, tags: int, tag_counts: tuple) -> dict:
+    """
+    fill fake CouchDB with container images like the collector stores them
+    :param couchdb:
+    :param images: number of container images
+    :param tags: number of tags of most container images
+    :param tag_counts: numbers of tags of the container images used for the tag filter
+    :return: hashes of the container images with many tags by their number of tags
+    """
+    databases = {name: couchdb.databases.setdefault(name, FakeDatabase())
+                 for name in ('container_images', 'container_image_tags', 'project_readmes')}
+    # most container images share the same tags, only the ones for the tag filter get more
+    common_tags = create_tags(tags)
+    hashes = dict()
+    for number in range(images):
+        project_id = number // 5 + 1
+        path = f'group{project_id // 100}/project{project_id}/image{number % 5}'
+        location = f'{REGISTRY}/{path}'
+        image_hash = sha256(location.encode()).hexdigest()
+        if number < len(tag_counts):
+            image_tags = create_tags(tag_counts[number])
+            hashes[tag_counts[number]] = image_hash
+        else:
+            image_tags = common_tags
+        tags_order = sort_tags(image_tags)
+        size = sum(x['total_size'] for x in image_tags.values())
+        databases['container_images'].write(
+            {'_id': location,
+             'id': number,
+             'hash': image_hash,
+             'location': location,
+             'name': location,
+             'path': path,
+             'project_id': project_id,
+             'registry': REGISTRY,
+             'last_update': image_tags[tags_order[0]]['created_at'],
+             'last_update_tag': tags_order[0],
+             'tag': tags_order[0],
+             'tags_count': len(image_tags),
+             'size': size,
+             'size_human_readable': format_size(size),
+             'created': image_tags[tags_order[0]]['created_at'],
+             'age_human_readable': '1 year',
+             'project': {'id': project_id,
+                         'description': f'Synthetic project {project_id}',
+                         'web_url': f'https://gitlab.bench/{path}',
+                         'container_expiration_policy': {'enabled': True}}})
+        databases['container_image_tags'].write(
+            {'_id': location,
+             'hash': image_hash,
+             'location': location,
+             'project_id': project_id,
+             'registry': REGISTRY,
+             'tags': image_tags,
+             'tags_order': tags_order})
+        if number % 5 == 0:
+            databases['project_readmes'].write(
+                {'_id': str(project_id),
+                 'project_id': project_id,
+                 'registry': REGISTRY,
+                 'readme_md': f'# Project {project_id}',
+                 'readme_html': f'<h3>Project {project_id}</h3>'})
+    return hashes
+
+
+def serve_fake(connection, images: int, tags: int, tag_counts: tuple) -> None:
+    """
+    run populated fake CouchDB until the benchmark ends
+    :param connection: pipe to send URL and hashes to
+    :param images:
+    :param tags:
+    :param tag_counts:
+    """
+    couchdb = FakeCouchDB()
+    hashes = populate(couchdb, images, tags, tag_counts)
+    couchdb.start()
+    connection.send((couchdb.url, hashes))
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+
+
+def measure(client, requests: int, method: str, url: str, **kwargs) -> dict:
+    """
+    send the same request repeatedly
+    :param client: Flask test client
+    :param requests: number of requests
+    :param method: 'get' or 'post'
+    :param url:
+    :param kwargs: passed to the client, e.g. data and headers
+    :return: latency percentiles in milliseconds and throughput
+    """
+    latencies = list()
+    start = perf_counter()
+    for _ in range(requests):
+        request_start = perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        latencies.append(perf_counter() - request_start)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{url} failed with status {response.status_code}')
+    seconds = perf_counter() - start
+    latencies.sort()
+
+    def percentile(fraction: float) -> float:
+        return round(latencies[int(fraction * (len(latencies) - 1))] * 1000, 2)
+
+    return {'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'requests_per_second': round(requests / seconds, 1)}
+
+
+def parse_arguments(arguments: list):
+    """
+    :param arguments: command line arguments
+    :return: parsed arguments
+    """
+    parser = ArgumentParser(description='latency benchmark of the web frontend')
+    parser.add_argument('--images', type=int, default=50000, help='number of container images')
+    parser.add_argument('--tags', type=int, default=5, help='tags of most container images')
+    parser.add_argument('--tag-counts', type=int, nargs='+', default=[10, 100, 1000, 5000],
+                        help='numbers of tags of the container images used for the tag filter')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--json', action='store_true', help='print results as JSON to compare versions')
+    return parser.parse_args(arguments)
+
+
+def main(arguments) -> dict:
+    """
+    run all scenarios
+    :param arguments: parsed command line arguments
+    :return: results by scenario
+    """
+    connection, fake_connection = Pipe()
+    fake = Process(target=serve_fake,
+                   args=(fake_connection, arguments.images, arguments.tags, tuple(arguments.tag_counts)),
+                   daemon=True)
+    fake.start()
+    couchdb_url, hashes = connection.recv()
+
+    config_file = Path(mkdtemp()) / 'config.yaml'
+    config_file.write_text(safe_dump({'api': {'url': 'https://gitlab.bench', 'token': 'benchmark'},
+                                      'registry': REGISTRY,
+                                      'couchdb': {'url': couchdb_url, 'user': 'admin', 'password': 'admin'}}))
+    # the frontend reads its config from the command line when imported
+    argv[1:] = ['--config-file', str(config_file), '--mode', 'web']
+    from backend.helpers import log
+    log.setLevel('WARNING')
+    start = perf_counter()
+    from frontend.index import app
+    results = {'startup_seconds': round(perf_counter() - start, 2)}
+
+    client = app.test_client()
+    htmx = {'HX-Request': 'true'}
+    results['/search/'] = measure(client, arguments.requests, 'get', '/search/')
+    # revisiting an unchanged page, e.g. by the back button, is answered by 304 Not Modified
+    etag = client.get('/search/', headers={'Accept-Encoding': 'gzip'}).headers.get('ETag')
+    results['/search/ revalidated'] = measure(client, arguments.requests, 'get', '/search/',
+                                              headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    # suggestions while typing - only the first request of a prefix computes them, later ones are cached
+    for prefix in ('g', 'group1', 'project42/im'):
+        url = f'/suggestions/?search={prefix}'
+        results[url] = measure(client, arguments.requests, 'get', url, headers=htmx)
+    for search_string in ('', 'image1'):
+        for page in PAGE_DEPTHS:
+            url = f'/search/{search_string}?mode=scroll&page={page}'
+            results[url] = measure(client, arguments.requests, 'get', url, headers=htmx)
+    for tag_count, image_hash in sorted(hashes.items()):
+        url = f'/container_image/{image_hash}/tab/tags/filter'
+        results[f'tags filter, {tag_count} tags'] = measure(client, arguments.requests, 'post', url,
+                                                            data={'filter': '1'}, headers=htmx)
+        results[f'tags page 2, {tag_count} tags'] = measure(client, arguments.requests, 'get', f'{url}?page=2',
+                                                            headers=htmx)
+    # followers of the changes feed lose their connection when the fake stops
+    log.setLevel('CRITICAL')
+    connection.close()
+    fake.join(timeout=5)
+    return results
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments(argv[1:])
+    results = main(arguments)
+    if arguments.json:
+        print(dumps(results))
+    else:
+        print(f"startup with {arguments.images} container images: {results.pop('startup_seconds')} s")
+        print(f"{'scenario':60} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+        for scenario, result in results.items():
+            print(f"{scenario[:60]:60} {result['p50_ms']:9} {result['p95_ms']:9} {result['p99_ms']:9} "
+                  f"{result['requests_per_second']:9}")
@@ -0,0 +1,209 @@
+# benchmark of refreshes triggered by webhooks against a local fake GitLab and fake CouchDB
+# run from repository root, e.g.: python -m benchmark.webhook --projects 1000 --refreshes 50 --events 5
+# bursts of GitLab push events and registry notifications are posted to the webhook receiver of the collector
+
+from argparse import ArgumentParser
+from json import dumps
+from multiprocessing import Pipe, \
+    Process
+from pathlib import Path
+from socket import socket
+from sys import argv
+from tempfile import mkdtemp
+from threading import Condition, \
+    Thread
+from time import perf_counter, \
+    sleep
+
+from httpx import Client, \
+    get
+from yaml import safe_dump
+
+from benchmark.collector import collector_settings, \
+    serve_fakes
+from benchmark.fake_gitlab import Dataset
+
+TOKEN = 'benchmark'
+
+
+def parse_arguments(arguments: list):
+    """
+    :param arguments: command line arguments
+    :return: parsed arguments
+    """
+    parser = ArgumentParser(description='benchmark of webhook refreshes')
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--repositories', type=int, default=5, help='container images per project')
+    parser.add_argument('--tags', type=int, default=20, help='tags per container image')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every GitLab response')
+    parser.add_argument('--jitter', type=float, default=0, help='maximal seconds randomly added to latency')
+    parser.add_argument('--refreshes', type=int, default=20, help='number of projects to be refreshed')
+    parser.add_argument('--events', type=int, default=5, help='events per project, alternating push events and '
+                                                              'registry notifications')
+    parser.add_argument('--debounce', type=float, default=0.5, help='seconds without events before a refresh')
+    parser.add_argument('--during-sweep', action='store_true', help='refresh while a full sweep is running')
+    parser.add_argument('--set', action='append', default=list(), metavar='KEY=VALUE',
+                        help='collector setting like workers.tags=4 or tag_concurrency=8')
+    parser.add_argument('--json', action='store_true', help='print results as JSON to compare versions')
+    return parser.parse_args(arguments)
+
+
+def free_port() -> int:
+    with socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def events(dataset: Dataset, project_id: int, count: int) -> list:
+    """
+    events of a burst, like GitLab and the container registry send them after a push and a pipeline
+    :param dataset:
+    :param project_id:
+    :param count:
+    :return:
+    """
+    result = list()
+    for number in range(count):
+        if number % 2 == 0:
+            result.append({'object_kind': 'push', 'project_id': project_id})
+        else:
+            repository = dataset.repository(project_id, number % dataset.repositories)['path']
+            result.append({'events': [{'action': 'push', 'target': {'repository': repository}}]})
+    return result
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 1) if values else 0
+
+
+def main(arguments) -> dict:
+    """
+    sweep once, then post bursts of events and measure until all projects are refreshed
+    :param arguments: parsed command line arguments
+    :return: results
+    """
+    dataset = Dataset(arguments.projects, arguments.repositories, arguments.tags)
+    connection, fakes_connection = Pipe()
+    fakes = Process(target=serve_fakes,
+                    args=(fakes_connection, dataset, arguments.latency, arguments.jitter, 0),
+                    daemon=True)
+    fakes.start()
+    gitlab_url, couchdb_url = connection.recv()
+
+    port = free_port()
+    collector = collector_settings(arguments.set)
+    collector['webhook'] = {'port': port,
+                            'address': '127.0.0.1',
+                            'token': TOKEN,
+                            'debounce': arguments.debounce,
+                            'max_delay': arguments.debounce * 10}
+    config_file = Path(mkdtemp()) / 'config.yaml'
+    config_file.write_text(safe_dump({'api': {'url': gitlab_url, 'token': 'benchmark'},
+                                      'registry': dataset.registry,
+                                      'couchdb': {'url': couchdb_url, 'user': 'admin', 'password': 'admin'},
+                                      'collector': collector}))
+    # the collector reads its config from the command line when imported
+    argv[1:] = ['--config-file', str(config_file), '--mode', 'collect']
+    from backend.collect import readme_cache, \
+        refresh_projects, \
+        sweep_projects
+    from backend.helpers import log
+    from backend.webhook import RefreshQueue, \
+        WebhookServer
+    log.setLevel('WARNING')
+
+    start = perf_counter()
+    sweep_projects(full_sweep=True)
+    results = {'projects': dataset.projects,
+               'initial_sweep_seconds': round(perf_counter() - start, 3)}
+
+    # project ID -> time its refresh finished
+    refreshed = dict()
+    refreshed_condition = Condition()
+    refresh_calls = list()
+
+    def timed_refresh(references: list) -> None:
+        refresh_calls.append(len(references))
+        refresh_projects(references)
+        now = perf_counter()
+        with refreshed_condition:
+            for reference in references:
+                # repository paths look like 'group0/project5/image1'
+                project_id = reference if isinstance(reference, int) else int(reference.split('/')[1][7:])
+                refreshed.setdefault(project_id, now)
+            refreshed_condition.notify()
+
+    # same wiring as start_webhook_server, but with refreshes timed
+    queue = RefreshQueue(timed_refresh, debounce=arguments.debounce, max_delay=arguments.debounce * 10)
+    queue.start()
+    server = WebhookServer(queue, address='127.0.0.1', port=port, token=TOKEN)
+    server.start()
+
+    sweep = None
+    if arguments.during_sweep:
+        sweep = Thread(target=sweep_projects, kwargs={'full_sweep': True})
+        sweep.start()
+        # let the sweep get going before the first events arrive
+        sleep(0.1)
+
+    project_ids = [1 + x * dataset.projects // arguments.refreshes
+                   for x in range(min(arguments.refreshes, dataset.projects))]
+    bursts = {x: events(dataset, x, arguments.events) for x in project_ids}
+    gitlab_before = get(f'{gitlab_url}/_stats').json()
+    downloads_before = readme_cache.downloads
+    # project ID -> time of its first event
+    first_events = dict()
+    accept_latencies = list()
+    start = perf_counter()
+    with Client(base_url=f'http://127.0.0.1:{port}', headers={'X-Gitlab-Token': TOKEN}) as client:
+        # bursts of several projects interleave like in a busy GitLab
+        for number in range(arguments.events):
+            for project_id in project_ids:
+                first_events.setdefault(project_id, perf_counter())
+                sent = perf_counter()
+                response = client.post('/', json=bursts[project_id][number])
+                accept_latencies.append((perf_counter() - sent) * 1000)
+                assert response.status_code == 202, response.status_code
+        rejected = client.post('/', json={'project_id': 1}, headers={'X-Gitlab-Token': 'wrong'}).status_code
+    with refreshed_condition:
+        refreshed_condition.wait_for(lambda: all(x in refreshed for x in project_ids), timeout=300)
+    seconds = perf_counter() - start
+    if sweep:
+        sweep.join()
+        seconds = perf_counter() - start
+    gitlab_after = get(f'{gitlab_url}/_stats').json()
+    server.stop()
+
+    refresh_latencies = [(refreshed[x] - first_events[x]) * 1000 for x in project_ids if x in refreshed]
+    results.update({'refreshed_projects': len(refresh_latencies),
+                    'events': len(accept_latencies),
+                    'refresh_calls': len(refresh_calls),
+                    'seconds': round(seconds, 3),
+                    'accept_p50_ms': percentile(accept_latencies, 0.5),
+                    'accept_p95_ms': percentile(accept_latencies, 0.95),
+                    'refresh_p50_ms': percentile(refresh_latencies, 0.5),
+                    'refresh_p95_ms': percentile(refresh_latencies, 0.95),
+                    'gitlab_requests': gitlab_after['requests'] - gitlab_before['requests'],
+                    'readme_downloads': readme_cache.downloads - downloads_before,
+                    'wrong_token_status': rejected})
+    connection.close()
+    fakes.join(timeout=5)
+    return results
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments(argv[1:])
+    results = main(arguments)
+    if arguments.json:
+        print(dumps(results))
+    else:
+        print(f"{results['projects']} projects, initial sweep {results['initial_sweep_seconds']:.2f} s")
+        print(f"{results['events']} events for {results['refreshed_projects']} projects refreshed "
+              f"in {results['refresh_calls']} refreshes within {results['seconds']:.2f} s"
+              f"{' during a sweep' if arguments.during_sweep else ''}")
+        print(f"accepted in p50 {results['accept_p50_ms']} ms, p95 {results['accept_p95_ms']} ms - "
+              f"refreshed after first event in p50 {results['refresh_p50_ms']} ms, "
+              f"p95 {results['refresh_p95_ms']} ms")
+        print(f"{results['gitlab_requests']} GitLab requests, {results['readme_downloads']} README downloads, "
+              f"wrong token answered with {results['wrong_token_status']}")
@@ -0,0 +1,124 @@
+# static assets with content hashes in their names, precompressed at startup and cached by browsers forever
+
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from mimetypes import guess_type
+from pathlib import Path
+from re import compile
+
+from flask import Blueprint, \
+    make_response, \
+    request
+
+from backend.helpers import log
+from frontend.misc import brotli_compress, \
+    choose_encoding
+
+STATIC_DIRECTORY = Path(__file__).parent / 'static'
+URL_PREFIX = '/assets'
+# images like PNG and fonts like WOFF are compressed already
+COMPRESSIBLE_SUFFIXES = ('.css', '.js', '.svg')
+# references between assets like url("/static/fonts/bootstrap-icons.woff") in stylesheets
+STATIC_REFERENCE = compile(r'/static/([\w./-]+)')
+# a year, the longest time browsers respect
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# take name for blueprint from file for flawless copy&paste
+blueprint = Blueprint(Path(__file__).stem, __name__)
+
+
+class Asset:
+    """
+    content of a static file, together with its compressed variants
+    """
+    __slots__ = ('mimetype', 'etag', 'variants')
+
+    def __init__(self, content: bytes, mimetype: str, compress: bool):
+        """
+        :param content: content of file
+        :param mimetype:
+        :param compress: add gzip and brotli variants if they are smaller
+        """
+        self.mimetype = mimetype
+        self.etag = sha256(content).hexdigest()[:32]
+        # encoding -> content, None for the uncompressed one
+        self.variants = {None: content}
+        if compress:
+            variants = {'gzip': gzip_compress(content, compresslevel=9)}
+            if brotli_compress:
+                variants['br'] = brotli_compress(content, quality=11)
+            for encoding, variant in variants.items():
+                if len(variant) < len(content):
+                    self.variants[encoding] = variant
+
+
+class AssetManifest:
+    """
+    fingerprinted names of all static files, like 'css/custom.css' -> 'css/custom.0a1b2c3d4e.css'
+    """
+
+    def __init__(self, directory: Path = STATIC_DIRECTORY):
+        """
+        :param directory: directory of static files
+        """
+        # path below static directory -> fingerprinted path
+        self.paths = dict()
+        # fingerprinted path -> Asset
+        self.assets = dict()
+        files = sorted(x for x in directory.rglob('*') if x.is_file())
+        # stylesheets refer to other assets, whose fingerprinted names have to be known first
+        for file in sorted(files, key=lambda x: x.suffix == '.css'):
+            self.add(file.relative_to(directory).as_posix(), file.read_bytes())
+        log.info(f'Prepared {len(self.assets)} static assets')
+
+    def add(self, path: str, content: bytes) -> None:
+        """
+        add asset under its fingerprinted name
+        :param path: path below static directory
+        :param content:
+        """
+        suffix = Path(path).suffix
+        if suffix == '.css':
+            content = STATIC_REFERENCE.sub(lambda x: self.url(x.group(1)), content.decode()).encode()
+        fingerprint = sha256(content).hexdigest()[:10]
+        fingerprinted_path = f'{path.removesuffix(suffix)}.{fingerprint}{suffix}'
+        mimetype = guess_type(path)[0] or 'application/octet-stream'
+        self.paths[path] = fingerprinted_path
+        self.assets[fingerprinted_path] = Asset(content, mimetype, suffix in COMPRESSIBLE_SUFFIXES)
+
+    def url(self, path: str) -> str:
+        """
+        URL of an asset to be used in templates
+        :param path: path below static directory like 'css/custom.css'
+        :return: fingerprinted URL or the plain static one for unknown files
+        """
+        if path in self.paths:
+            return f'{URL_PREFIX}/{self.paths[path]}'
+        return f'/static/{path}'
+
+
+asset_manifest = AssetManifest()
+
+
+@blueprint.route('/<path:fingerprinted_path>', methods=['GET'])
+def serve_asset(fingerprinted_path: str):
+    """
+    serve precompressed asset - its name changes with its content, so it never has to be requested again
+    :param fingerprinted_path:
+    :return:
+    """
+    asset = asset_manifest.assets.get(fingerprinted_path)
+    if not asset:
+        # not the catch-all redirect to search, a missing asset should stay missing
+        return make_response('', 404)
+    encoding = choose_encoding(tuple(x for x in ('br', 'gzip') if x in asset.variants))
+    response = make_response(asset.variants[encoding])
+    response.mimetype = asset.mimetype
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if len(asset.variants) > 1:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(f'{asset.etag}-{encoding}' if encoding else asset.etag)
+    # reloads and other revalidations get a 304 without the content
+    return response.make_conditional(request)
@@ -1,6 +1,5 @@
 # all treatment of container_images aka images
 
-from copy import deepcopy
 from pathlib import Path
 
 from flask import Blueprint, \
@@ -8,19 +7,42 @@ from flask import Blueprint, \
     request, \
     render_template
 
-from backend.database import couchdb
+from backend.helpers import sort_tags
+from frontend.document_cache import container_images_cache, \
+    readmes_cache, \
+    tags_cache
 from frontend.misc import is_htmx
-
-
-db = couchdb.get_database_object('container_images')
+from frontend.search import get_page
 
 # tabs for container repository details
 container_image_TABS = ['tags', 'readme']
+# tags per page, more are loaded while scrolling
+TAGS_PER_PAGE = 50
 
 # take name for blueprint from file for flawless copy&paste
 blueprint = Blueprint(Path(__file__).stem, __name__)
 
 
+def get_tags_page(tags_document: dict = None, filter_string: str = '', page: int = 1) -> tuple:
+    """
+    get one page of tags, newest first, whose names contain the filter string
+    :param tags_document: document containing tags and their order
+    :param filter_string: lowercase filter string
+    :param page: number of page, starting with 1
+    :return: list of tags and if there are more
+    """
+    if not tags_document:
+        return list(), False
+    tags = tags_document.get('tags', dict())
+    # order is computed by the collector - older documents might come without
+    tags_order = tags_document.get('tags_order') or sort_tags(tags)
+    if filter_string:
+        tags_order = [x for x in tags_order if filter_string in x.lower()]
+    start = (page - 1) * TAGS_PER_PAGE
+    tags_page = [tags[x] for x in tags_order[start:start + TAGS_PER_PAGE] if x in tags]
+    return tags_page, len(tags_order) > start + TAGS_PER_PAGE
+
+
 @blueprint.route('/<container_image_hash>/tab/<tab>/filter', methods=['GET', 'POST'])
 @blueprint.route('/<container_image_hash>/tab/<tab>', methods=['GET'])
 @blueprint.route('/<container_image_hash>', methods=['GET'])
@@ -34,11 +56,11 @@ def container_image(container_image_hash: int = None, tab=None):
     search_string = ''
     filter_string = ''
 
-    search_result_db = db.find(selector={'hash': container_image_hash}, use_index='hash')
+    # repeated requests for the same container image, e.g. while filtering tags, are served from cache
+    container_image = container_images_cache.get(container_image_hash)
 
-    pass
     # only process if there was a valid container involved
-    if search_result_db and len(search_result_db) == 1:
+    if container_image:
         # tab to be shown
         tab_selected = tab
         # if there is none the first one will be chosen
@@ -46,39 +68,32 @@ def container_image(container_image_hash: int = None, tab=None):
             template = 'container_image/index.html'
             tab_selected = container_image_TABS[0]
         elif is_htmx() and tab in container_image_TABS:
-            if request.form.get('filter') or request.form.get('filter') == '':
-                filter_string = request.form['filter'].strip().lower()
+            if request.values.get('filter') or request.values.get('filter') == '':
+                filter_string = request.values['filter'].strip().lower()
             # direct calls via GET will receive the start view
-            if not filter_string and request.method == 'GET':
+            if not filter_string and request.method == 'GET' and not request.args.get('page'):
                 template = 'container_image/tabs.html'
-            # filtering attempts will receive a filtered list
+            # filtering attempts and further pages will receive a filtered list
             else:
                 template = 'container_image/tab/tags_list.html'
-        # get single requested repository - can only be one
-        container_image = search_result_db[0]
+        # tags and README are stored separately and only loaded for the tab which shows them
+        tags = list()
+        tags_more = False
+        readme = dict()
+        page = get_page(request)
+        if tab_selected == 'tags':
+            tags, tags_more = get_tags_page(tags_cache.get(container_image['location']), filter_string, page)
+        elif tab_selected == 'readme':
+            readme = readmes_cache.get(str(container_image['project_id'])) or dict()
         # search_string is for back-button
         if request.args.get('search_string'):
             search_string = request.args['search_string']
-        # htmx-based request
-        if tab and \
-                is_htmx() and \
-                tab in container_image_TABS:
-            filter_string = ''
-            if request.form.get('filter') or request.form.get('filter') == '':
-                # to be refined
-                filter_string = request.form['filter'].strip().lower()
-            if filter_string and request.method == 'POST':
-                filter_results = dict()
-                for name, tag in container_image['tags'].items():
-                    if filter_string.lower() in name.lower():
-                        filter_results.update({name: tag})
-                # get a copy of container_image to use filtered tags
-                container_image_filtered = deepcopy(container_image)
-                container_image_filtered['tags'] = filter_results
-                # use filtered copy
-                container_image = container_image_filtered
         return render_template(template,
                                container_image=container_image,
+                               tags=tags,
+                               tags_more=tags_more,
+                               page=page,
+                               readme=readme,
                                container_image_hash=container_image_hash,
                                container_image_TABS=container_image_TABS,
                                is_htmx=is_htmx(),
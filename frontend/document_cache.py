@@ -0,0 +1,132 @@
+# read-through cache of documents shown on container image pages, invalidated by the CouchDB changes feed
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from backend.config import config
+from backend.database import couchdb, \
+    CouchDBChangesFollower
+from frontend.search_index import changes_follower, \
+    db
+
+
+class DocumentCache:
+    """
+    size-bounded LRU cache of documents, filled by a loader on a miss and invalidated by document changes
+    """
+
+    def __init__(self, name: str, loader, size: int = 0, key_of_id=None):
+        """
+        :param name: name of the cache, used for metrics
+        :param loader: called with a key on a miss, returns the document or None
+        :param size: maximal number of cached documents, 0 disables the cache
+        :param key_of_id: maps the ID of a changed document to the cache key, if they differ
+        """
+        self.name = name
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._loader = loader
+        self._key_of_id = key_of_id or (lambda x: x)
+        self._documents = OrderedDict()
+        # counts invalidations - a document loaded while its key got invalidated might be outdated already
+        self._generation = 0
+        # requests and the changes feed run in different threads
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        get document from cache or load it
+        :param key:
+        :return: document or None if it does not exist
+        """
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+            generation = self._generation
+        document = self._loader(key)
+        if document is not None and self.size:
+            with self._lock:
+                if generation == self._generation:
+                    self._documents[key] = document
+                    while len(self._documents) > self.size:
+                        self._documents.popitem(last=False)
+        return document
+
+    def invalidate(self, changes: list) -> None:
+        """
+        drop changed documents - subscriber of the changes feed
+        :param changes: list of changes with 'id'
+        """
+        with self._lock:
+            self._generation += 1
+            for change in changes:
+                self._documents.pop(self._key_of_id(change['id']), None)
+
+    def metrics(self) -> dict:
+        """
+        size and hit/miss counters
+        :return:
+        """
+        with self._lock:
+            return {'size': len(self._documents),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def __len__(self):
+        return len(self._documents)
+
+
+def load_container_image(container_image_hash: str) -> dict:
+    """
+    load container image by its hash
+    :param container_image_hash:
+    :return: container image or None
+    """
+    search_result_db = db.find(selector={'hash': container_image_hash}, use_index='hash')
+    # only a single match is a valid container image
+    if search_result_db and len(search_result_db) == 1:
+        return search_result_db[0]
+    return None
+
+
+def follow(database, cache: DocumentCache) -> CouchDBChangesFollower:
+    """
+    invalidate cache by changes of a database, starting from its current state
+    :param database:
+    :param cache:
+    :return:
+    """
+    follower = CouchDBChangesFollower(database, since=database.update_seq())
+    follower.subscribe(cache.invalidate)
+    follower.start()
+    return follower
+
+
+db_tags = couchdb.get_database_object('container_image_tags')
+db_readmes = couchdb.get_database_object('project_readmes')
+
+# container images are requested by hash which is derived from their location aka document ID
+container_images_cache = DocumentCache('container_images',
+                                       load_container_image,
+                                       config.web.document_cache_size,
+                                       key_of_id=lambda x: sha256(x.encode()).hexdigest())
+# the search index already follows the container images
+changes_follower.subscribe(container_images_cache.invalidate)
+
+# tags are stored by location, READMEs by project ID
+tags_cache = DocumentCache('container_image_tags',
+                           db_tags.get_by_id,
+                           config.web.document_cache_size)
+tags_changes_follower = follow(db_tags, tags_cache)
+readmes_cache = DocumentCache('project_readmes',
+                              db_readmes.get_by_id,
+                              config.web.document_cache_size)
+readmes_changes_follower = follow(db_readmes, readmes_cache)
+
+document_caches = [container_images_cache, tags_cache, readmes_cache]
@@ -1,17 +1,59 @@
 from pathlib import Path
+from time import time
 
 from flask import Blueprint, \
+    jsonify, \
     redirect, \
     render_template
 
+from backend.database import couchdb
+from frontend.document_cache import document_caches
 from frontend.misc import is_htmx
 
+# seconds after which a sweep without status updates counts as aborted
+STATUS_TIMEOUT = 300
+
+db_status = couchdb.get_database_object('collector_status')
+
 # take name for blueprint from file for flawless copy&paste
 blueprint = Blueprint(Path(__file__).stem, __name__)
 
+
+def get_update_status() -> dict:
+    """
+    summarize progress of running sweeps - several ones if the collectors are sharded
+    :return:
+    """
+    now = time()
+    sweeps = [x for x in db_status.find(selector={'_id': {'$gt': None}})
+              if x.get('running') and now - x.get('updated', 0) < STATUS_TIMEOUT]
+    projects_done = sum(x.get('projects_done', 0) for x in sweeps)
+    # the first sweep has nothing to compare with
+    if all(x.get('projects_expected') for x in sweeps):
+        projects_expected = sum(max(x['projects_expected'], x.get('projects_done', 0)) for x in sweeps)
+    else:
+        projects_expected = 0
+    return {'running': bool(sweeps),
+            'stage': ', '.join(sorted({x.get('stage', '') for x in sweeps})),
+            'projects_done': projects_done,
+            'projects_expected': projects_expected,
+            'container_images_done': sum(x.get('container_images_done', 0) for x in sweeps),
+            # without expectation from a previous sweep there is no percentage
+            'percent': 100 * projects_done // projects_expected if projects_expected else None}
+
+
 @blueprint.route('/progress')
 def progress():
     if is_htmx():
-        return render_template('health/progress.html')
+        return render_template('health/progress.html', update_status=get_update_status())
     else:
         return redirect('/search/')
+
+
+@blueprint.route('/cache')
+def cache():
+    """
+    hit and miss counters of the document caches
+    :return:
+    """
+    return jsonify({x.name: x.metrics() for x in document_caches})
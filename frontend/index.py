@@ -1,33 +1,129 @@
 # central index /
 
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from json import dumps
 from secrets import token_hex
 
 from time import time
 
 from flask import Flask, \
+    g, \
+    make_response, \
     redirect, \
-    render_template_string
+    render_template_string, \
+    request, \
+    session
 
+from backend.config import config
+from frontend.assets import asset_manifest, \
+    blueprint as assets_blueprint, \
+    URL_PREFIX as ASSETS_URL_PREFIX
 from frontend.container_image import blueprint as container_image_blueprint
+from frontend.document_cache import readmes_changes_follower, \
+    tags_changes_follower
 from frontend.health import blueprint as health_blueprint
-from frontend.search import blueprint as search_blueprint
-from frontend.misc import blueprint as misc_blueprint
+from frontend.search import blueprint as search_blueprint, \
+    SORT_ORDERS
+from frontend.search_index import changes_follower, \
+    search_index, \
+    SORTABLE_BY
+from frontend.suggestions import blueprint as suggestions_blueprint
+from frontend.misc import blueprint as misc_blueprint, \
+    brotli_compress, \
+    choose_encoding, \
+    is_htmx
+
+# blueprints whose GET responses only depend on the request and the databases, so they can be revalidated by ETag
+CACHEABLE_BLUEPRINTS = ('search', 'container_image', 'suggestions')
+# seconds an ETag stays valid without any database change, as pages show ages relative to now
+ETAG_LIFETIME = 60
+# types of responses worth compressing
+COMPRESSIBLE_MIMETYPES = ('text/html', 'application/json')
 
 app = Flask(__name__)
 
 # as there is no further session management the secret key might be regenerated with every new start
 app.secret_key = token_hex()
 
-# add timestamp to jinja-globals
-app.jinja_env.globals.update(timestamp=int(time()))
+# fingerprinted URLs of static files for templates
+app.jinja_env.globals.update(asset=asset_manifest.url)
 
 # add blueprint routes
+app.register_blueprint(assets_blueprint, url_prefix=ASSETS_URL_PREFIX)
 app.register_blueprint(container_image_blueprint, url_prefix='/container_image')
 app.register_blueprint(health_blueprint, url_prefix='/health')
 app.register_blueprint(search_blueprint, url_prefix='/search')
+app.register_blueprint(suggestions_blueprint, url_prefix='/suggestions')
 app.register_blueprint(misc_blueprint)
 
 
+def etag_of_request() -> str:
+    """
+    ETag of the response to the current request, without rendering it
+    the update sequences seen by the changes followers change with every document stored by the collector
+    :return:
+    """
+    sequences = [x.since for x in (changes_follower, tags_changes_follower, readmes_changes_follower)]
+    key = dumps([sequences,
+                 int(time() // ETAG_LIFETIME),
+                 request.full_path,
+                 is_htmx(),
+                 # sorting is kept in the session, the first request gets the defaults
+                 session.get('sort_by', list(SORTABLE_BY.keys())[0]),
+                 session.get('sort_order', list(SORT_ORDERS.keys())[0])],
+                default=str)
+    return sha256(key.encode()).hexdigest()[:32]
+
+
+@app.before_request
+def answer_not_modified():
+    """
+    answer with 304 if the client already has the current version - before CouchDB gets queried or anything rendered
+    """
+    # an empty index shows the progress of the collector, which changes without any stored document
+    if request.method != 'GET' or request.blueprint not in CACHEABLE_BLUEPRINTS or not len(search_index):
+        return None
+    g.etag = etag_of_request()
+    # compressed responses carry the encoding as suffix of their ETag
+    for etag in request.if_none_match.as_set():
+        if etag.split('-')[0] == g.etag:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.vary.update(('Accept-Encoding', 'Cookie', 'HX-Request'))
+            return response
+    return None
+
+
+@app.after_request
+def compress_and_tag(response):
+    """
+    compress large responses and add ETag
+    :param response:
+    :return:
+    """
+    encoding = None
+    if response.status_code == 200 and not response.direct_passthrough and not response.is_streamed \
+            and response.mimetype in COMPRESSIBLE_MIMETYPES and 'Content-Encoding' not in response.headers:
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if config.web.compression_min_size and len(data) >= config.web.compression_min_size:
+            encoding = choose_encoding()
+            if encoding == 'br':
+                response.set_data(brotli_compress(data, quality=5))
+            elif encoding == 'gzip':
+                response.set_data(gzip_compress(data, compresslevel=6))
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+    if g.get('etag') and response.status_code == 200:
+        # encodings are different representations, so they need different ETags
+        response.set_etag(f'{g.etag}-{encoding}' if encoding else g.etag)
+        # browsers have to revalidate every time, which is cheap now
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.update(('Cookie', 'HX-Request'))
+    return response
+
+
 @app.errorhandler(404)
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
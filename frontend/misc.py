@@ -1,12 +1,24 @@
 # miscellaneous small stuff
 
+from datetime import datetime, \
+    timezone
 from pathlib import Path
-from re import IGNORECASE, \
+from re import escape, \
+    IGNORECASE, \
     sub
 
+from dateutil.relativedelta import relativedelta
 from flask import Blueprint, \
     request
 
+from backend.helpers import humanize_age
+
+# brotli is optional - without it responses are compressed with gzip
+try:
+    from brotli import compress as brotli_compress
+except ImportError:
+    brotli_compress = None
+
 # take name for blueprint from file for flawless copy&paste
 blueprint = Blueprint(Path(__file__).stem, __name__)
 
@@ -21,6 +33,21 @@ def is_htmx():
     else:
         return False
 
+
+def choose_encoding(available: tuple = ('br', 'gzip')) -> str:
+    """
+    best content encoding accepted by the client
+    :param available: encodings available for the response, in order of preference
+    :return: 'br', 'gzip' or None
+    """
+    for encoding in available:
+        if encoding == 'br' and not brotli_compress:
+            continue
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
 @blueprint.app_template_filter('highlight')
 def highlight_filter(string, highlight_string):
     """
@@ -31,6 +58,23 @@ def highlight_filter(string, highlight_string):
     """
     if highlight_string:
         # class highlight has to be defined in CSS
-        return sub(highlight_string, f'<span class="highlight">{highlight_string}</span>', string, flags=IGNORECASE)
+        # the matched text is used as it is, so its case is kept and backslashes are no group references
+        return sub(escape(highlight_string), lambda x: f'<span class="highlight">{x.group(0)}</span>', string,
+                   flags=IGNORECASE)
     else:
         return string
+
+
+@blueprint.app_template_filter('age')
+def age_filter(timestamp):
+    """
+    human-readable age of a stored timestamp, calculated when rendering so it does not depend on the last collection
+    :param timestamp: ISO formatted timestamp
+    :return:
+    """
+    if timestamp:
+        try:
+            return humanize_age(relativedelta(datetime.now(timezone.utc), datetime.fromisoformat(timestamp)))
+        except (TypeError, ValueError):
+            pass
+    return 'n/a'
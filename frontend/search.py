@@ -9,23 +9,19 @@ from flask import Blueprint, \
     session
 
 from backend.config import config
-from backend.database import couchdb
 
+from frontend.health import get_update_status
 from frontend.misc import is_htmx
+from frontend.search_index import db, \
+    search_index, \
+    SORTABLE_BY
 
-# sorting keys and their defaults
-SORTABLE_BY = {'name': '',
-               'created': '1970-01-01T00:00:00.000000+00:00',
-               'size': 0,
-               'tag': ''}
 SORT_ORDERS = {'up': False, 'down': True}
 RESULTS_PER_PAGE = 10
 
 # take name for blueprint from file for flawless copy&paste
 blueprint = Blueprint(Path(__file__).stem, __name__)
 
-db = couchdb.get_database_object('container_images')
-
 
 def process_search_request(request=None, session=None, search_string: str = ''):
     """
@@ -70,51 +66,49 @@ def process_search_request(request=None, session=None, search_string: str = ''):
     if request.form.get('search') or request.form.get('search') == '':
         # to be refined
         search_string = request.form['search'].strip().lower()
-    # add matching container_images to search results
-
-    # for name, container_image in container_images_cache.index_by_name.items():
-    #     if search_string.lower() in name.lower():
-    #         search_results.update({name: container_image})
-
-    search_results_db = db.find(selector={'path': {'$regex': f'.*{search_string.lower()}.*'}}, use_index='path')
-
-    if isinstance(search_results_db, list):
-        # sort by sort_order
-        search_results_sorted = dict(sorted({x.get('name'): x for x in search_results_db}.items(),
-                                            key=lambda x: x[1].get(sort_by, SORTABLE_BY[sort_by]),
-                                            reverse=SORT_ORDERS.get(sort_order)))
-    else:
-        search_results_sorted = dict()
-
-    # take only sorted values as list
-    search_results_list = list(search_results_sorted.values())
-    # count number of results
-    search_results_count = len(search_results_list)
-    # paginate_search_results() delivers page-related information and paginated list of results
-    search_results_list_paginated, page, pages_count = paginate_search_results(request, search_results_list)
-
-    return search_string, search_results_list_paginated, search_results_count, page, pages_count
+    # count matching container_images
+    search_results_count = len(search_index.search(search_string.lower()))
+    pages_count = (search_results_count // RESULTS_PER_PAGE) + 1
+    page = get_page(request)
+    # the sorted page is taken from the index - the cursor continues where the previous page ended
+    cursor = request.args.get('cursor')
+    search_results_list_paginated, next_cursor = search_index.page(search_string.lower(),
+                                                                   sort_by=sort_by,
+                                                                   descending=SORT_ORDERS.get(sort_order),
+                                                                   cursor=cursor,
+                                                                   skip=0 if cursor else (page - 1) * RESULTS_PER_PAGE,
+                                                                   size=RESULTS_PER_PAGE)
+    # only the documents of the current page are loaded from the database
+    search_results_list_paginated = load_search_results(search_results_list_paginated)
+
+    return search_string, search_results_list_paginated, search_results_count, page, pages_count, next_cursor
+
+
+def load_search_results(search_results: list = None) -> list:
+    """
+    load whole documents of index entries, keeping their order
+    :param search_results: list of index entries
+    :return: list of documents
+    """
+    # fetched by ID - the documents of a sorted page are spread over the whole database
+    # documents might have been deleted meanwhile
+    return db.get_by_ids([x['_id'] for x in search_results])
 
 
-def paginate_search_results(request=None, search_results: list = None):
+def get_page(request=None) -> int:
     """
-    cut search result into pieces aka pages
+    get number of requested page
     :param request:
-    :param search_results:
     :return:
     """
-    pages_count = (len(search_results) // RESULTS_PER_PAGE) + 1
     if not request.args.get('page'):
         page = 1
     else:
         try:
-            page = int(request.args['page'])
+            page = max(1, int(request.args['page']))
         except ValueError:
             page = 1
-
-    search_results_paginated = search_results[(page - 1) * RESULTS_PER_PAGE:page * RESULTS_PER_PAGE]
-
-    return search_results_paginated, page, pages_count
+    return page
 
 
 @blueprint.route('/<part1>/<part2>/<part3>/<part4>/<part5>/', methods=['GET'])
@@ -142,8 +136,8 @@ def search(search_string: str = '', part1: str = '', part2: str = '', part3: str
         if any(parts) and request.base_url.endswith('/'):
             search_string += '/'
     # for pagination the request will be processed and the result split into page pieces
-    search_string, search_results, search_results_count, page, pages_count = process_search_request(request, session,
-                                                                                                    search_string)
+    search_string, search_results, search_results_count, page, pages_count, cursor = \
+        process_search_request(request, session, search_string)
     # modes 'sort' and 'scroll' are used for sorting of results and paginated infinite scroll
     # otherwise the default whole index will be shown
     if not request.args.get('mode') or request.args.get('mode') not in ['sort', 'scroll']:
@@ -151,15 +145,20 @@ def search(search_string: str = '', part1: str = '', part2: str = '', part3: str
     else:
         template = '/search/results.html'
 
+    # an empty index might be still in the making - show progress of the collector then
+    update_status = get_update_status() if not search_results_count and not search_string else None
+
     # use Response to add URL for browser historx via header
     response = make_response(render_template(template,
                                              is_htmx=is_htmx(),
                                              gitlab_url=config.api.url,
                                              page=page,
                                              pages_count=pages_count,
+                                             cursor=cursor,
                                              search_string=search_string,
                                              search_results=search_results,
                                              search_results_count=search_results_count,
+                                             update_status=update_status,
                                              session=session,
                                              SORTABLE_BY=SORTABLE_BY,
                                              SORT_ORDERS=SORT_ORDERS))
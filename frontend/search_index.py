@@ -0,0 +1,329 @@
+# in-memory trigram index of container image paths, kept current by following the CouchDB changes feed
+
+from base64 import urlsafe_b64decode, \
+    urlsafe_b64encode
+from bisect import bisect_left, \
+    bisect_right, \
+    insort
+from heapq import nlargest, \
+    nsmallest
+from json import dumps, \
+    loads
+from threading import Lock
+
+from backend.database import couchdb, \
+    CouchDBChangesFollower
+from backend.helpers import log
+
+# sorting keys and their defaults
+SORTABLE_BY = {'name': '',
+               'created': '1970-01-01T00:00:00.000000+00:00',
+               'size': 0,
+               'tag': ''}
+# fields needed for searching and sorting - whole documents are only loaded for the results actually shown
+INDEX_FIELDS = ['_id', 'path'] + list(SORTABLE_BY.keys())
+# keys suggestions may be ranked by, largest first - newest or biggest container images
+RANKABLE_BY = ('created', 'size')
+# above this number of matching paths it is cheaper to walk the ranking until enough of them are found
+DENSE_PREFIX_MATCHES = 1000
+# up to this number of trigram candidates a page is sorted from them instead of walking the whole sort order
+SPARSE_PAGE_CANDIDATES = 2000
+# number of cached suggestions, each stays valid until a container image matching its prefix changes
+SUGGESTIONS_CACHE_SIZE = 1000
+
+
+class SearchIndex:
+    """
+    trigram index for substring search in container image paths, and prefix index for their suggestions
+    """
+
+    def __init__(self, database):
+        """
+        :param database: CouchDBDatabase containing the container images
+        """
+        self._database = database
+        # document ID -> fields needed for search and sorting
+        self._entries = dict()
+        # trigram -> set of document IDs whose path contains it
+        self._trigrams = dict()
+        # sort key -> sorted list of (value, document ID) for keyset pagination
+        self._sorted = {key: list() for key in SORTABLE_BY}
+        # sorted list of (path or its tail starting at a segment, document ID) for prefix search via bisect
+        self._prefixes = list()
+        # (prefix, size, rank key) -> suggestions
+        self._suggestions = dict()
+        # the changes feed updates the index in its own thread
+        self._lock = Lock()
+
+    @staticmethod
+    def trigrams(string: str) -> set:
+        """
+        all 3-character substrings of a string
+        :param string:
+        :return:
+        """
+        return {string[position:position + 3] for position in range(len(string) - 2)}
+
+    @staticmethod
+    def tails(path: str) -> list:
+        """
+        path and its tails starting at every segment, so e.g. the project or image name can be typed first
+        'group/project/image' -> ['group/project/image', 'project/image', 'image']
+        :param path: lowercase path
+        :return:
+        """
+        parts = path.split('/')
+        return ['/'.join(parts[index:]) for index in range(len(parts))]
+
+    @staticmethod
+    def sort_value(entry: dict, sort_by: str):
+        """
+        value of an entry to sort by - missing or odd values get the default to stay comparable
+        :param entry:
+        :param sort_by:
+        :return:
+        """
+        value = entry.get(sort_by)
+        default = SORTABLE_BY[sort_by]
+        if value is None or type(value) != type(default):
+            return default
+        return value
+
+    @staticmethod
+    def encode_cursor(position: tuple) -> str:
+        """
+        encode position in sort order to be carried by htmx
+        :param position: tuple of sort value and document ID
+        :return:
+        """
+        return urlsafe_b64encode(dumps(list(position)).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple:
+        """
+        decode position in sort order
+        :param cursor:
+        :return: tuple of sort value and document ID or None if invalid
+        """
+        try:
+            value, document_id = loads(urlsafe_b64decode(cursor.encode()))
+            return value, document_id
+        except (TypeError, ValueError):
+            return None
+
+    def load(self) -> str:
+        """
+        load all container images into the index
+        :return: update sequence of the database before loading, to follow changes from there
+        """
+        since = self._database.update_seq()
+        documents = self._database.find(selector={'_id': {'$gt': None}}, fields=INDEX_FIELDS)
+        with self._lock:
+            for document in documents:
+                self._add(document, keep_sorted=False)
+            # sorting once is much cheaper than inserting every document in order
+            for positions in self._sorted.values():
+                positions.sort()
+            self._prefixes.sort()
+        log.info(f'Search index loaded with {len(self._entries)} container images')
+        return since
+
+    def _add(self, document: dict, keep_sorted: bool = True) -> None:
+        """
+        add or replace a document - lock has to be held
+        :param document:
+        :param keep_sorted: if False the positions are only appended and the lists have to be sorted afterwards
+        """
+        if not document.get('path'):
+            return
+        self._remove(document['_id'])
+        entry = dict(document)
+        entry['path_lower'] = document['path'].lower()
+        self._entries[document['_id']] = entry
+        for trigram in self.trigrams(entry['path_lower']):
+            self._trigrams.setdefault(trigram, set()).add(document['_id'])
+        add = insort if keep_sorted else list.append
+        for sort_by, positions in self._sorted.items():
+            add(positions, (self.sort_value(entry, sort_by), document['_id']))
+        for tail in self.tails(entry['path_lower']):
+            add(self._prefixes, (tail, document['_id']))
+        self._invalidate_suggestions(entry['path_lower'])
+
+    def _remove(self, document_id: str) -> None:
+        """
+        remove a document - lock has to be held
+        :param document_id:
+        """
+        entry = self._entries.pop(document_id, None)
+        if entry:
+            for sort_by, positions in self._sorted.items():
+                position = (self.sort_value(entry, sort_by), document_id)
+                index = bisect_left(positions, position)
+                if index < len(positions) and positions[index] == position:
+                    del positions[index]
+            for trigram in self.trigrams(entry['path_lower']):
+                document_ids = self._trigrams.get(trigram)
+                if document_ids:
+                    document_ids.discard(document_id)
+                    if not document_ids:
+                        del self._trigrams[trigram]
+            for tail in self.tails(entry['path_lower']):
+                index = bisect_left(self._prefixes, (tail, document_id))
+                if index < len(self._prefixes) and self._prefixes[index] == (tail, document_id):
+                    del self._prefixes[index]
+            self._invalidate_suggestions(entry['path_lower'])
+
+    def _invalidate_suggestions(self, path: str) -> None:
+        """
+        drop cached suggestions a changed path might belong to - lock has to be held
+        :param path: lowercase path
+        """
+        if self._suggestions:
+            tails = self.tails(path)
+            for key in [x for x in self._suggestions if any(tail.startswith(x[0]) for tail in tails)]:
+                del self._suggestions[key]
+
+    def update(self, changes: list) -> None:
+        """
+        apply changes from the changes feed
+        :param changes: list of changes with 'id' and optionally 'deleted'
+        """
+        changed_ids = [x['id'] for x in changes if not x.get('deleted')]
+        # only the fields needed for searching and sorting are kept
+        documents = [{key: x[key] for key in INDEX_FIELDS if key in x}
+                     for x in self._database.get_by_ids(changed_ids)]
+        with self._lock:
+            for change in changes:
+                if change.get('deleted'):
+                    self._remove(change['id'])
+            for document in documents:
+                self._add(document)
+
+    def search(self, search_string: str = '') -> list:
+        """
+        find all container images whose path contains the search string
+        :param search_string: lowercase search string
+        :return: list of index entries
+        """
+        with self._lock:
+            if not search_string:
+                return list(self._entries.values())
+            if len(search_string) < 3:
+                # too short for trigrams - the paths are short enough to be scanned
+                return [x for x in self._entries.values() if search_string in x['path_lower']]
+            return self._matches(self._candidates(search_string), search_string)
+
+    def _candidates(self, search_string: str) -> set:
+        """
+        IDs of documents containing all trigrams of the search string - lock has to be held
+        :param search_string: lowercase search string of at least 3 characters
+        :return:
+        """
+        candidates = sorted((self._trigrams.get(x, set()) for x in self.trigrams(search_string)), key=len)
+        return set.intersection(*candidates) if candidates[0] else set()
+
+    def _matches(self, document_ids: set, search_string: str) -> list:
+        """
+        entries of candidates which really contain the search string - lock has to be held
+        trigrams may appear in the wrong order, so the candidates have to be checked
+        :param document_ids:
+        :param search_string: lowercase search string
+        :return: list of index entries
+        """
+        return [entry for entry in (self._entries[x] for x in document_ids) if search_string in entry['path_lower']]
+
+    def page(self, search_string: str = '', sort_by: str = 'name', descending: bool = False, cursor: str = None,
+             skip: int = 0, size: int = 10) -> tuple:
+        """
+        get one page of matching container images in sort order, starting after the cursor
+        the cost depends on the page size and the density of matches, not on the depth of the page
+        :param search_string: lowercase search string
+        :param sort_by: key of SORTABLE_BY
+        :param descending: sort order
+        :param cursor: position after which the page starts, as delivered with the previous page
+        :param skip: number of matches to skip if there is no cursor
+        :param size: number of entries per page
+        :return: list of index entries and cursor for the next page
+        """
+        position = self.decode_cursor(cursor) if cursor else None
+        if position and type(position[0]) != type(SORTABLE_BY[sort_by]):
+            # cursor belongs to another sort key
+            position = None
+        with self._lock:
+            candidates = self._candidates(search_string) if len(search_string) >= 3 else None
+            if candidates is not None and len(candidates) <= SPARSE_PAGE_CANDIDATES:
+                # few matches - sorting them is cheaper than walking the sort order until enough are found
+                matches = [(self.sort_value(x, sort_by), x['_id']) for x in self._matches(candidates, search_string)]
+                if position:
+                    matches = [x for x in matches if (x < position if descending else x > position)]
+                selected = (nlargest if descending else nsmallest)(skip + size, matches)[skip:]
+                entries = [self._entries[x[1]] for x in selected]
+                return entries, self.encode_cursor(selected[-1]) if selected else ''
+            positions = self._sorted[sort_by]
+            if descending:
+                start = bisect_left(positions, position) - 1 if position else len(positions) - 1
+                indices = range(start, -1, -1)
+            else:
+                start = bisect_right(positions, position) if position else 0
+                indices = range(start, len(positions))
+            entries = list()
+            last_position = None
+            for index in indices:
+                entry = self._entries[positions[index][1]]
+                if search_string in entry['path_lower']:
+                    if skip:
+                        skip -= 1
+                        continue
+                    entries.append(entry)
+                    last_position = positions[index]
+                    if len(entries) == size:
+                        break
+        return entries, self.encode_cursor(last_position) if last_position else ''
+
+    def suggest(self, prefix: str, size: int = 10, rank_by: str = 'created') -> list:
+        """
+        get paths of container images whose path or one of its segments starts with the prefix
+        :param prefix: lowercase prefix
+        :param size: maximal number of suggestions
+        :param rank_by: key of RANKABLE_BY - the largest values come first
+        :return: list of paths
+        """
+        if not prefix:
+            return list()
+        key = (prefix, size, rank_by)
+        with self._lock:
+            suggestions = self._suggestions.get(key)
+            if suggestions is not None:
+                return suggestions
+            # all tails starting with the prefix are next to each other
+            start = bisect_left(self._prefixes, (prefix,))
+            end = bisect_left(self._prefixes, (prefix + '\uffff',), lo=start)
+            if end - start <= DENSE_PREFIX_MATCHES:
+                # several tails of the same path might match
+                document_ids = {x[1] for x in self._prefixes[start:end]}
+                entries = nlargest(size, (self._entries[x] for x in document_ids),
+                                   key=lambda x: (self.sort_value(x, rank_by), x['_id']))
+            else:
+                # a short prefix matches many paths - enough of them are found early in the ranking
+                entries = list()
+                for _, document_id in reversed(self._sorted[rank_by]):
+                    entry = self._entries[document_id]
+                    if entry['path_lower'].startswith(prefix) or f'/{prefix}' in entry['path_lower']:
+                        entries.append(entry)
+                        if len(entries) == size:
+                            break
+            suggestions = [x['path'] for x in entries]
+            if len(self._suggestions) >= SUGGESTIONS_CACHE_SIZE:
+                self._suggestions.clear()
+            self._suggestions[key] = suggestions
+        return suggestions
+
+    def __len__(self):
+        return len(self._entries)
+
+
+db = couchdb.get_database_object('container_images')
+search_index = SearchIndex(db)
+changes_follower = CouchDBChangesFollower(db, since=search_index.load())
+changes_follower.subscribe(search_index.update)
+changes_follower.start()
@@ -0,0 +1,30 @@
+# suggestions for the search box while typing - served from the in-memory index without touching CouchDB
+
+from pathlib import Path
+
+from flask import Blueprint, \
+    render_template, \
+    request
+
+from frontend.search_index import RANKABLE_BY, \
+    search_index
+
+# number of suggestions shown below the search box
+SUGGESTIONS_COUNT = 10
+
+# take name for blueprint from file for flawless copy&paste
+blueprint = Blueprint(Path(__file__).stem, __name__)
+
+
+@blueprint.route('/', methods=['GET'])
+def suggestions():
+    """
+    options for the datalist of the search box
+    :return:
+    """
+    prefix = request.args.get('search', '').strip().lower()
+    rank_by = request.args.get('rank_by')
+    if rank_by not in RANKABLE_BY:
+        rank_by = RANKABLE_BY[0]
+    return render_template('/search/suggestions.html',
+                           suggestions=search_index.suggest(prefix, size=SUGGESTIONS_COUNT, rank_by=rank_by))